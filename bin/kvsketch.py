@@ -0,0 +1,426 @@
+## Compact summary structures stored in transaction documents by the kvtransaction commands
+##
+## Every structure is loaded from the value stored in the kv store once per transaction, updated in memory
+## and dumped back to a JSON serializable value when the transaction gets saved.
+#
+
+import base64, collections, hashlib, json, math
+
+
+## Supporting function: Returns the bytes of a field value to be hashed
+#
+def encode_value(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    elif not isinstance(value, str):
+        return str(value)
+    return value
+
+
+## Event deduplication: Remembers the checksums of events which already contributed to a transaction
+##
+## "list"   keeps every checksum (unbounded, exact)
+## "window" keeps the most recent checksums only (bounded, exact for recent events)
+## "bloom"  keeps a fixed-size Bloom filter (bounded, may drop a new event as duplicate at the configured error rate)
+#
+DEDUP_MODES = ('list', 'window', 'bloom')
+
+
+class HashList(object):
+    def __init__(self, hashes=None, size=None):
+        self.size   = size
+        self.hashes = collections.deque(hashes or [], size)
+        self.lookup = set(self.hashes)
+
+    def __contains__(self, digest):
+        return digest in self.lookup
+
+    def add(self, digest):
+        ## Forget the oldest checksum once the window is full
+        #
+        if self.size is not None and len(self.hashes) == self.size:
+            self.lookup.discard(self.hashes[0])
+        self.hashes.append(digest)
+        self.lookup.add(digest)
+
+    def dump(self):
+        return list(self.hashes)
+
+
+class BloomFilter(object):
+    prefix = 'bloom:'
+
+    def __init__(self, bits, hashes, data=None):
+        self.bits   = bits
+        self.hashes = hashes
+        self.data   = data if data is not None else bytearray((bits + 7) // 8)
+
+    @classmethod
+    def create(cls, capacity, error_rate):
+        bits   = int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        hashes = max(1, int(round(float(bits) / capacity * math.log(2))))
+        return cls(bits, hashes)
+
+    @classmethod
+    def load(cls, value):
+        bits, hashes, data = value[len(cls.prefix):].split(':', 2)
+        return cls(int(bits), int(hashes), bytearray(base64.b64decode(data)))
+
+    def _positions(self, digest):
+        ## Derive all bit positions from the two halves of the hex digest (double hashing)
+        #
+        h1 = int(digest[:16], 16)
+        h2 = int(digest[16:32], 16) | 1
+        return [(h1 + i * h2) % self.bits for i in xrange(self.hashes)]
+
+    def __contains__(self, digest):
+        data = self.data
+        for position in self._positions(digest):
+            if not data[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    def add(self, digest):
+        data = self.data
+        for position in self._positions(digest):
+            data[position >> 3] |= 1 << (position & 7)
+
+    def dump(self):
+        return '%s%s:%s:%s' % (self.prefix, self.bits, self.hashes, base64.b64encode(bytes(self.data)))
+
+
+## Supporting function: Loads the deduplication state stored in a transaction's _hashes field
+## Stored checksum lists are converted to the requested mode. A stored Bloom filter cannot be converted back and is kept.
+#
+def load_dedup(value, mode='list', size=10000, error_rate=0.001):
+    if isinstance(value, basestring) and value.startswith(BloomFilter.prefix):
+        return BloomFilter.load(value)
+
+    if value is None or value == '':
+        hashes = []
+    elif isinstance(value, list):
+        hashes = value
+    else:
+        hashes = [value]
+
+    if mode == 'bloom':
+        dedup = BloomFilter.create(size, error_rate)
+        for digest in hashes:
+            dedup.add(digest)
+        return dedup
+    elif mode == 'window':
+        return HashList(hashes, size)
+    else:
+        return HashList(hashes)
+
+
+## Supporting function: Merges the deduplication state of two transactions
+## A Bloom filter can take up any checksum, but cannot hand its own out. Of two Bloom filters
+## with different dimensions the second one is dropped.
+#
+def merge_dedup(dedup, other):
+    if isinstance(other, HashList):
+        for digest in other.hashes:
+            if digest not in dedup:
+                dedup.add(digest)
+        return dedup
+    elif isinstance(dedup, HashList):
+        return merge_dedup(other, dedup)
+    elif (dedup.bits, dedup.hashes) == (other.bits, other.hashes):
+        for index, byte in enumerate(other.data):
+            dedup.data[index] |= byte
+    return dedup
+
+
+## Distinct count estimation: HyperLogLog sketch with 2^precision one byte registers
+## Sketches are mergeable, the standard error of the estimate is about 1.04 / sqrt(2^precision)
+#
+class HyperLogLog(object):
+    prefix = 'hll:'
+
+    def __init__(self, precision=10, registers=None):
+        self.precision = precision
+        self.registers = registers if registers is not None else bytearray(1 << precision)
+
+    @classmethod
+    def load(cls, value):
+        precision, data = value[len(cls.prefix):].split(':', 1)
+        return cls(int(precision), bytearray(base64.b64decode(data)))
+
+    def add(self, value):
+        self.add_hash(int(hashlib.md5(encode_value(value)).hexdigest()[:16], 16))
+
+    def add_hash(self, digest):
+        ## Takes the first 64 bits of a value's md5 digest as integer
+        #
+        width  = 64 - self.precision
+        index  = digest >> width
+        rank   = width - (digest & ((1 << width) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        for index, rank in enumerate(other.registers):
+            if rank > self.registers[index]:
+                self.registers[index] = rank
+
+    def estimate(self):
+        m        = len(self.registers)
+        alpha    = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum([2.0 ** -rank for rank in self.registers])
+        zeros    = self.registers.count(b'\x00')
+        ## Use linear counting for small cardinalities
+        #
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+    def dump(self):
+        return '%s%s:%s' % (self.prefix, self.precision, base64.b64encode(bytes(self.registers)))
+
+
+## Exact distinct count: Set of 8 byte digests of the values seen
+## Stored as a single base64 string, which is a lot smaller than the values themselves.
+## Above "limit" distinct values the digests are replaced by a HyperLogLog sketch of constant size, so the count
+## becomes an estimate. The sketch hashes the same 64 bits, so converting loses no values.
+#
+class DigestSet(object):
+    prefix = 'digests:'
+
+    def __init__(self, digests=None, limit=10000, sketch=None):
+        self.digests = digests if digests is not None else set()
+        self.limit   = limit
+        self.sketch  = sketch
+
+    @classmethod
+    def load(cls, value, limit=10000):
+        if value.startswith(HyperLogLog.prefix):
+            return cls(None, limit, HyperLogLog.load(value))
+        data = base64.b64decode(value[len(cls.prefix):])
+        return cls(set([data[i:i + 8] for i in xrange(0, len(data), 8)]), limit)
+
+    def __len__(self):
+        if self.sketch is not None:
+            return self.sketch.estimate()
+        return len(self.digests)
+
+    def _convert(self):
+        self.sketch = HyperLogLog()
+        for digest in self.digests:
+            self.sketch.add_hash(int(digest.encode('hex'), 16))
+        self.digests = None
+
+    def add(self, value):
+        if self.sketch is not None:
+            self.sketch.add(value)
+            return
+        self.digests.add(hashlib.md5(encode_value(value)).digest()[:8])
+        if len(self.digests) > self.limit:
+            self._convert()
+
+    def merge(self, other):
+        if other.sketch is not None and self.sketch is None:
+            self._convert()
+        if self.sketch is not None:
+            if other.sketch is not None:
+                self.sketch.merge(other.sketch)
+            else:
+                for digest in other.digests:
+                    self.sketch.add_hash(int(digest.encode('hex'), 16))
+            return
+        self.digests.update(other.digests)
+        if len(self.digests) > self.limit:
+            self._convert()
+
+    def dump(self):
+        if self.sketch is not None:
+            return self.sketch.dump()
+        return '%s%s' % (self.prefix, base64.b64encode(''.join(sorted(self.digests))))
+
+
+## Quantile estimation: Merging t-digest with centroids of (mean, count)
+## Centroids near the median may grow larger than those at the tails, which keeps extreme quantiles accurate.
+## The number of centroids is bounded by about compression / 2, digests are mergeable.
+#
+class TDigest(object):
+    prefix = 'tdigest:'
+
+    def __init__(self, compression=200, centroids=None, minimum=None, maximum=None):
+        self.compression = compression
+        self.centroids   = centroids if centroids is not None else []
+        self.minimum     = minimum
+        self.maximum     = maximum
+        self.buffer      = []
+
+    @classmethod
+    def load(cls, value):
+        ## Minimum and maximum of a digest without values are empty, earlier versions stored them as "None"
+        #
+        compression, minimum, maximum, data = value[len(cls.prefix):].split(':', 3)
+        centroids = []
+        for centroid in data.split(';') if data else []:
+            mean, count = centroid.split(',')
+            centroids.append([float(mean), int(count)])
+        return cls(int(compression), centroids,
+                   float(minimum) if minimum not in ('', 'None') else None,
+                   float(maximum) if maximum not in ('', 'None') else None)
+
+    def __len__(self):
+        return sum([count for mean, count in self.centroids]) + sum([count for mean, count in self.buffer])
+
+    def add(self, value, count=1):
+        value = float(value)
+        if self.minimum is None or value < self.minimum:
+            self.minimum = value
+        if self.maximum is None or value > self.maximum:
+            self.maximum = value
+        self.buffer.append([value, count])
+        if len(self.buffer) >= 5 * self.compression:
+            self.compress()
+
+    def merge(self, other):
+        for mean, count in other.centroids + other.buffer:
+            self.add(mean, count)
+        if other.minimum is not None and other.minimum < self.minimum:
+            self.minimum = other.minimum
+        if other.maximum is not None and other.maximum > self.maximum:
+            self.maximum = other.maximum
+
+    def _limit(self, cumulative, total):
+        k = self.compression / (2 * math.pi) * math.asin(2 * cumulative / total - 1) + 1
+        if k >= self.compression / 4.0:
+            return total
+        return total * (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def compress(self):
+        if not self.buffer:
+            return
+        items       = sorted(self.centroids + self.buffer)
+        total       = float(sum([count for mean, count in items]))
+        self.buffer = []
+
+        ## Merge neighbouring centroids as long as they span at most one unit of the scale function
+        ## k(q) = compression / (2 pi) * asin(2q - 1), which keeps centroids small near q = 0 and q = 1
+        #
+        centroids  = []
+        cumulative = 0
+        current    = list(items[0])
+        limit      = self._limit(0, total)
+        for mean, count in items[1:]:
+            if cumulative + current[1] + count <= limit:
+                current[1] += count
+                current[0] += (mean - current[0]) * count / current[1]
+            else:
+                cumulative += current[1]
+                centroids.append(current)
+                current = [mean, count]
+                limit   = self._limit(cumulative, total)
+        centroids.append(current)
+        self.centroids = centroids
+
+    def quantile(self, q):
+        self.compress()
+        if not self.centroids:
+            return None
+
+        ## Interpolate linearly between the centers of the centroids, the minimum and the maximum
+        #
+        total  = sum([count for mean, count in self.centroids])
+        target = q * total
+        points = [(0, self.minimum)]
+        cumulative = 0
+        for mean, count in self.centroids:
+            points.append((cumulative + count / 2.0, mean))
+            cumulative += count
+        points.append((total, self.maximum))
+
+        for (position, value), (next_position, next_value) in zip(points, points[1:]):
+            if target <= next_position:
+                if next_position == position:
+                    return next_value
+                return value + (next_value - value) * (target - position) / (next_position - position)
+        return self.maximum
+
+    def dump(self):
+        self.compress()
+        return '%s%s:%s:%s:%s' % (self.prefix, self.compression,
+                                  repr(self.minimum) if self.minimum is not None else '',
+                                  repr(self.maximum) if self.maximum is not None else '',
+                                  ';'.join(['%r,%d' % (mean, count) for mean, count in self.centroids]))
+
+
+## Heavy hitters: Space-Saving summary with a fixed number of counters
+## A value which is not counted yet replaces the value with the smallest count and inherits that count as its error.
+## Every value occurring more often than total / capacity is guaranteed to be kept. Each counter keeps [count, error],
+## the value's true count lies between count - error and count. The capacity defaults to ten times the number of
+## values listed, but at least 100 counters, so that the listed values are rarely the ones which got replaced.
+#
+class SpaceSaving(object):
+    prefix = 'topk:'
+
+    def __init__(self, size=10, capacity=None, counters=None):
+        self.size     = size
+        self.capacity = capacity or max(10 * size, 100)
+        self.counters = counters if counters is not None else {}
+
+    @classmethod
+    def load(cls, value, capacity=None):
+        size, stored, data = value[len(cls.prefix):].split(':', 2)
+        counters = dict([(item, [count, error]) for item, count, error in json.loads(data)])
+        summary  = cls(int(size), int(stored), counters)
+        if capacity and capacity != summary.capacity:
+            summary.capacity = capacity
+            summary._truncate()
+        return summary
+
+    def _minimum(self):
+        ## Upper bound of the count of any value not counted: the smallest count once all counters are in use
+        #
+        if len(self.counters) < self.capacity:
+            return 0
+        return min([counter[0] for counter in self.counters.itervalues()])
+
+    def _truncate(self):
+        if len(self.counters) > self.capacity:
+            items = sorted(self.counters.iteritems(), key=lambda item: (-item[1][0], item[0]))
+            self.counters = dict(items[:self.capacity])
+
+    def add(self, value, count=1):
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += count
+        elif len(self.counters) < self.capacity:
+            self.counters[value] = [count, 0]
+        else:
+            smallest = min(self.counters, key=lambda item: self.counters[item][0])
+            minimum  = self.counters.pop(smallest)[0]
+            self.counters[value] = [minimum + count, minimum]
+
+    def merge(self, other):
+        ## A value missing from one summary may have occurred up to that summary's minimum count there,
+        ## which gets added to both its count and its error. Keeps the values with the largest counts.
+        #
+        minimum       = self._minimum()
+        other_minimum = other._minimum()
+        for item, counter in self.counters.iteritems():
+            if item not in other.counters:
+                counter[0] += other_minimum
+                counter[1] += other_minimum
+        for item, (count, error) in other.counters.iteritems():
+            counter = self.counters.get(item)
+            if counter is not None:
+                counter[0] += count
+                counter[1] += error
+            else:
+                self.counters[item] = [count + minimum, error + minimum]
+        self._truncate()
+
+    def top(self, size=None):
+        ## Returns (value, guaranteed count) pairs ranked by their guaranteed count, i.e. count - error
+        #
+        items = sorted(self.counters.iteritems(), key=lambda item: (item[1][1] - item[1][0], item[0]))
+        return [(item, counter[0] - counter[1]) for item, counter in items[:size or self.size]]
+
+    def dump(self):
+        data = [[item, counter[0], counter[1]] for item, counter in self.counters.iteritems()]
+        return '%s%s:%s:%s' % (self.prefix, self.size, self.capacity, json.dumps(data, separators=(',', ':')))
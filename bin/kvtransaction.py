@@ -1,15 +1,617 @@
 #!/usr/bin/env python
 
-import sys, json, collections, itertools, time
-import urllib, hashlib
+import sys, json, collections, itertools, time, urllib, urlparse
+import hashlib, threading, random, fnmatch
 import splunklib.client as client
 import splunk.rest as rest
 
-from decimal import *
+from kvsketch import DEDUP_MODES, load_dedup, merge_dedup, HyperLogLog, DigestSet, TDigest, SpaceSaving
+
+from cStringIO import StringIO
+from multiprocessing.pool import ThreadPool
 from splunklib.searchcommands import \
     dispatch, StreamingCommand, Configuration, Option, validators
 
 
+## Hard limit for concurrent requests to the kv store per search and number of attempts per request
+#
+MAX_FETCH_WORKERS = 8
+MAX_SAVE_WORKERS  = 4
+FETCH_ATTEMPTS    = 3
+
+## Number of keys per delete request, keeping the query within the maximum URL length
+#
+DELETE_CHUNK_SIZE = 100
+
+## Policies for mvlist fields exceeding mvmax values
+#
+MV_POLICIES = ('first', 'last', 'reservoir')
+
+## Functions aggregating a field's values incrementally
+#
+AGGREGATE_FUNCTIONS = ('count', 'sum', 'min', 'max', 'first', 'last', 'dc', 'estdc', 'tdigest', 'top')
+
+## Fields calculated by kvtransaction, which never take part in an event's checksum
+#
+NON_IDENTITY_FIELDS = frozenset(['_key', '_hashes', 'event_count', 'duration', 'start_time', 'end_time', 'closed', 'close_time', 'generation'])
+
+
+## Field types and accelerated fields declared when provisioning a collection
+## Numeric timing fields let housekeeping searches compare numbers and use indexes instead of scanning the collection
+#
+NUMERIC_FIELDS = ('start_time', 'end_time', 'duration', 'event_count', 'close_time')
+INDEXED_FIELDS = (('start_time',), ('end_time',), ('closed', 'close_time'))
+
+
+## Supporting function: Serializes an object to JSON with sorted keys
+## Creating the encoder this way avoids the pure Python encoder just like RecordWriter._iterencode_json does
+#
+try:
+    from _json import make_encoder
+except ImportError:
+    _iterencode_json = json.JSONEncoder(separators=(',', ':'), sort_keys=True).iterencode
+else:
+    from json.encoder import encode_basestring_ascii
+
+    def _default(o):
+        raise TypeError(repr(o) + ' is not JSON serializable')
+
+    _iterencode_json = make_encoder(
+        None,                     # markers (events are never circular)
+        _default,                 # object_encoder
+        encode_basestring_ascii,  # string_encoder
+        None,                     # indent
+        ':', ',',                 # separators
+        True,                     # sort_keys
+        False,                    # skip_keys
+        True                      # allow_nan
+    )
+
+    del make_encoder
+
+
+## Supporting function: Calculates an event's checksum from the given identity fields or all fields calculated by the
+## search, independent of the order of the fields. The event itself is left untouched.
+#
+def fingerprint(event, fields=None):
+    if fields:
+        identity = {field:event.get(field) for field in fields}
+    else:
+        identity = {field:value for field, value in event.iteritems() if field not in NON_IDENTITY_FIELDS and not field.startswith('__latest_')}
+    return hashlib.md5(''.join(_iterencode_json(identity, 0))).hexdigest()
+
+
+## Supporting functions: Convert times in seconds as stored in the kv store from and to integer microseconds
+## Parsing the digits directly keeps the stored precision without any floating point rounding
+#
+def parse_time(value):
+    if isinstance(value, (int, long)):
+        return value * 1000000
+    if isinstance(value, float):
+        return int(round(value * 1000000))
+    value = value.strip()
+    try:
+        sign = -1 if value.startswith('-') else 1
+        seconds, _, fraction = value.lstrip('+-').partition('.')
+        return sign * (int(seconds or '0') * 1000000 + int((fraction + '000000')[:6]))
+    except ValueError:
+        return int(round(float(value) * 1000000))
+
+
+def time_seconds(usec):
+    return usec / 1000000.0
+
+
+def format_time(usec):
+    seconds, fraction = divmod(abs(usec), 1000000)
+    return '%s%d.%s' % ('-' if usec < 0 else '', seconds, ('%06d' % fraction).rstrip('0') or '0')
+
+
+## Supporting class: Insertion-ordered list of distinct values, used to deduplicate mvlist fields
+## Appending a value costs O(1), the values keep the order in which they were first seen
+#
+class UniqueList(object):
+    __slots__ = ('values', 'seen')
+
+    def __init__(self, values=()):
+        self.values = []
+        self.seen   = set()
+        self.extend(values)
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, value):
+        key = tuple(value) if isinstance(value, list) else value
+        if key not in self.seen:
+            self.seen.add(key)
+            self.values.append(value)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+
+## Supporting class: mvlist values capped at "size" values, deduplicated if "kept" is a set
+## "first" keeps the first values, "last" the latest values and "reservoir" a uniform random sample of all values.
+## Counts all values seen and estimates the number of distinct ones, no matter how many are kept.
+#
+class BoundedList(object):
+    __slots__ = ('values', 'size', 'policy', 'seen', 'distinct', 'kept')
+
+    def __init__(self, values, size, policy, seen=None, distinct=None, mvdedup=False):
+        ## Count a stored list without counters from all of its values, before it gets cut down to size
+        #
+        if seen is None:
+            seen = len(values)
+        if distinct is None:
+            distinct = HyperLogLog()
+            for value in values:
+                distinct.add(value)
+        if policy == 'first':
+            values = values[:size]
+        else:
+            values = values[-size:]
+        self.values   = collections.deque(values)
+        self.size     = size
+        self.policy   = policy
+        self.seen     = seen
+        self.distinct = distinct
+        self.kept     = None
+        if mvdedup:
+            self.kept = set([tuple(value) if isinstance(value, list) else value for value in values])
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def append(self, value):
+        self.seen += 1
+        self.distinct.add(value)
+        key = tuple(value) if isinstance(value, list) else value
+        if self.kept is not None and key in self.kept:
+            return
+
+        if len(self.values) < self.size:
+            self.values.append(value)
+        elif self.policy == 'last':
+            self.forget(self.values.popleft())
+            self.values.append(value)
+        elif self.policy == 'reservoir':
+            index = random.randrange(self.seen)
+            if index >= self.size:
+                return
+            self.forget(self.values[index])
+            self.values[index] = value
+        else:
+            return
+
+        if self.kept is not None:
+            self.kept.add(key)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def forget(self, value):
+        if self.kept is not None:
+            self.kept.discard(tuple(value) if isinstance(value, list) else value)
+
+    def dump(self, document, field):
+        document[field]                 = list(self.values)
+        document['mvseen_%s' % field]   = self.seen
+        document['mvdc_%s' % field]     = self.distinct.estimate()
+        document['__mvhll_%s' % field]  = self.distinct.dump()
+
+
+## Supporting function: Converts a field value to a number, returns None for non-numeric values
+#
+def parse_number(value):
+    if isinstance(value, (int, long, float)):
+        return value
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        pass
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+## Supporting class: Aggregate of a field's values, stored as scalar "<function>_<field>"
+## first and last additionally store the time of their value, dc stores the digests of up to 10000 distinct values
+## estdc stores a HyperLogLog sketch of constant size instead and exposes its estimate
+## tdigest only stores a quantile sketch, which kvtransactionoutput expands into percentiles
+## top stores a Space-Saving summary and exposes the most frequent values and their guaranteed counts as lists
+#
+class Aggregate(object):
+    __slots__ = ('function', 'field', 'name', 'value', 'time', 'digests', 'sketch')
+
+    def __init__(self, function, field, document, size=10, capacity=None):
+        self.function = function
+        self.field    = field
+        self.name     = '%s_%s' % (function, field)
+        self.value    = document.get(self.name)
+        self.time     = None
+        self.digests  = None
+        self.sketch   = None
+
+        if function in ('sum', 'min', 'max') and self.value is not None:
+            self.value = parse_number(self.value)
+        elif function in ('first', 'last') and document.get('__time_%s' % self.name):
+            self.time = parse_time(document['__time_%s' % self.name])
+        elif function == 'dc':
+            digests      = document.get('__%s' % self.name)
+            self.digests = DigestSet.load(digests) if digests else DigestSet()
+        elif function == 'estdc':
+            sketch       = document.get('__%s' % self.name)
+            self.sketch  = HyperLogLog.load(sketch) if sketch else HyperLogLog()
+        elif function == 'tdigest':
+            sketch       = document.get('__%s' % self.name)
+            self.sketch  = TDigest.load(sketch) if sketch else TDigest()
+        elif function == 'top':
+            sketch       = document.get('__%s' % self.name)
+            self.sketch  = SpaceSaving.load(sketch, capacity) if sketch else SpaceSaving(size, capacity)
+
+    def add(self, value, event_time):
+        ## Aggregate each value of multivalued fields
+        #
+        if isinstance(value, list):
+            for item in value:
+                self.add(item, event_time)
+            return
+
+        function = self.function
+        if function == 'count':
+            self.value = (self.value or 0) + 1
+        elif function == 'dc':
+            self.digests.add(value)
+        elif function in ('estdc', 'top'):
+            self.sketch.add(value)
+        elif function == 'tdigest':
+            number = parse_number(value)
+            if number is not None:
+                self.sketch.add(number)
+        elif function == 'first':
+            if self.time is None or event_time < self.time:
+                self.value = value
+                self.time  = event_time
+        elif function == 'last':
+            if self.time is None or event_time >= self.time:
+                self.value = value
+                self.time  = event_time
+        else:
+            number = parse_number(value)
+            if number is None:
+                return
+            if function == 'sum':
+                self.value = (self.value or 0) + number
+            elif function == 'min':
+                if self.value is None or number < self.value:
+                    self.value = number
+            elif function == 'max':
+                if self.value is None or number > self.value:
+                    self.value = number
+
+    def merge(self, other):
+        function = self.function
+        if function == 'dc':
+            self.digests.merge(other.digests)
+        elif function in ('estdc', 'tdigest', 'top'):
+            self.sketch.merge(other.sketch)
+        elif other.value is None:
+            return
+        elif function in ('count', 'sum'):
+            self.value = (self.value or 0) + other.value
+        elif function == 'first':
+            if self.time is None or (other.time is not None and other.time < self.time):
+                self.value = other.value
+                self.time  = other.time
+        elif function == 'last':
+            if self.time is None or (other.time is not None and other.time >= self.time):
+                self.value = other.value
+                self.time  = other.time
+        elif function == 'min':
+            if self.value is None or other.value < self.value:
+                self.value = other.value
+        elif function == 'max':
+            if self.value is None or other.value > self.value:
+                self.value = other.value
+
+    def dump(self, document):
+        if self.function == 'dc':
+            document[self.name]           = len(self.digests)
+            document['__%s' % self.name]  = self.digests.dump()
+            return
+        elif self.function == 'estdc':
+            document[self.name]           = self.sketch.estimate()
+            document['__%s' % self.name]  = self.sketch.dump()
+            return
+        elif self.function == 'tdigest':
+            document['__%s' % self.name]  = self.sketch.dump()
+            return
+        elif self.function == 'top':
+            top                                   = self.sketch.top()
+            document[self.name]                   = [item for item, count in top]
+            document['top_count_%s' % self.field] = [count for item, count in top]
+            document['__%s' % self.name]          = self.sketch.dump()
+            return
+        document[self.name] = self.value
+        if self.time is not None:
+            document['__time_%s' % self.name] = format_time(self.time)
+
+
+## Supporting class: In-memory state of a transaction while events get merged into it
+## Start and end time are kept as integer microseconds and converted only when loading and dumping the transaction
+## The values of mvlist fields are accumulated in lists, UniqueLists or BoundedLists and flattened when dumping the transaction
+## Aggregates are loaded once per field and dumped as scalars
+## A transaction once closed stays closed, close keeps the time it got closed at
+#
+class TransactionState(object):
+    __slots__ = ('dedup', 'start', 'end', 'count', 'mv', 'agg', 'close')
+
+    def __init__(self, document, dedup):
+        self.dedup = dedup
+        self.mv    = {}
+        self.agg   = {}
+        self.count = int(document.get('event_count', 0))
+        self.close = None
+        if document.get('closed') is True and document.get('close_time') is not None:
+            self.close = parse_time(document['close_time'])
+        if '_time' in document:
+            self.start = parse_time(document['_time'])
+            self.end   = self.start + parse_time(document.get('duration', 0))
+        else:
+            self.start = None
+            self.end   = None
+
+    def load_mv(self, document, field, mvdedup, size=None, policy=None):
+        values = document.get(field)
+        if values is None:
+            values = []
+        elif not isinstance(values, list):
+            values = [values]
+
+        if size:
+            distinct = document.get('__mvhll_%s' % field)
+            if distinct:
+                distinct = HyperLogLog.load(distinct)
+            self.mv[field] = BoundedList(values, size, policy, document.get('mvseen_%s' % field), distinct, mvdedup)
+        elif mvdedup:
+            self.mv[field] = UniqueList(values)
+        else:
+            self.mv[field] = values
+        return self.mv[field]
+
+    def load_agg(self, document, field, functions, size=10, capacity=None):
+        self.agg[field] = [Aggregate(function, field, document, size, capacity) for function in functions]
+        return self.agg[field]
+
+    def merge(self, other):
+        ## Take up the other transaction's time range, event count and checksums
+        #
+        self.dedup  = merge_dedup(self.dedup, other.dedup)
+        self.count += other.count
+        if other.start is not None and (self.start is None or other.start < self.start):
+            self.start = other.start
+        if other.end is not None and (self.end is None or other.end > self.end):
+            self.end = other.end
+
+    def add(self, event_time):
+        if self.start is None or event_time < self.start:
+            self.start = event_time
+        if self.end is None or event_time > self.end:
+            self.end = event_time
+        self.count += 1
+
+    def dump(self, document):
+        document['_hashes']     = self.dedup.dump()
+        document['start_time']  = time_seconds(self.start)
+        document['end_time']    = time_seconds(self.end)
+        document['duration']    = time_seconds(self.end - self.start)
+        document['event_count'] = self.count
+        document['_time']       = time_seconds(self.start)
+        for field, values in self.mv.iteritems():
+            if isinstance(values, BoundedList):
+                values.dump(document, field)
+            else:
+                document[field] = list(values)
+        for aggregates in self.agg.itervalues():
+            for aggregate in aggregates:
+                aggregate.dump(document)
+
+    def dump_closure(self, document, rules, watermark):
+        ## Until the transaction is closed, close_time is the time it will be closed at unless more events arrive
+        #
+        if self.close is None:
+            deadline = rules.deadline(self)
+            if deadline is not None and watermark is not None and deadline <= watermark:
+                self.close = deadline
+        else:
+            deadline = self.close
+        document['closed']     = self.close is not None
+        document['close_time'] = time_seconds(deadline) if deadline is not None else None
+
+
+## Supporting function: Parses a "<field>=<value>" predicate, the value may contain wildcards
+#
+def parse_predicate(name, value):
+    if not value:
+        return None
+    field, separator, pattern = value.partition('=')
+    if not separator or not field.strip():
+        raise ValueError('The argument "%s" is invalid: %s. Set to <field>=<value>.' % (name, value))
+    return field.strip(), pattern.strip()
+
+
+## Supporting class: Rules closing a transaction, evaluated while events get merged
+## maxspan and maxpause give the time a transaction will be closed at unless more events arrive,
+## an event matching endswith closes its transaction at once, as does an event matching startswith for the transaction before it.
+## Times are compared against the latest event time seen by the search instead of the wall clock.
+#
+class ClosureRules(object):
+    def __init__(self, maxspan=None, maxpause=None, startswith=None, endswith=None):
+        self.maxspan    = maxspan * 1000000 if maxspan is not None else None
+        self.maxpause   = maxpause * 1000000 if maxpause is not None else None
+        self.startswith = parse_predicate('startswith', startswith)
+        self.endswith   = parse_predicate('endswith', endswith)
+
+    def __nonzero__(self):
+        return any(rule is not None for rule in (self.maxspan, self.maxpause, self.startswith, self.endswith))
+
+    @staticmethod
+    def _match(predicate, event):
+        if predicate is None:
+            return False
+        field, pattern = predicate
+        values = event.get(field)
+        if values is None:
+            return False
+        if not isinstance(values, list):
+            values = [values]
+        return any(fnmatch.fnmatchcase(value, pattern) for value in values)
+
+    def starts(self, event):
+        return self._match(self.startswith, event)
+
+    def ends(self, event):
+        return self._match(self.endswith, event)
+
+    def splits(self, state, event, event_time):
+        ## Tells whether the event starts a new generation of the transaction
+        #
+        if state.end is None or event_time <= state.end:
+            return False
+        if state.close is not None or self.starts(event):
+            return True
+        deadline = self.deadline(state)
+        return deadline is not None and event_time > deadline
+
+    def deadline(self, state):
+        deadlines = []
+        if self.maxspan is not None:
+            deadlines.append(state.start + self.maxspan)
+        if self.maxpause is not None:
+            deadlines.append(state.end + self.maxpause)
+        return min(deadlines) if deadlines else None
+
+
+## Supporting function: Returns the aliases of all ids an event carries
+## Ids of the transaction_id field are used as they are, ids of linked fields are prefixed by the field name
+#
+def event_aliases(event, transaction_id, link_fields):
+    aliases = []
+    for field in [transaction_id] + link_fields:
+        values = event.get(field)
+        if not values:
+            continue
+        for value in values if isinstance(values, list) else [values]:
+            aliases.append(value if field == transaction_id else '%s=%s' % (field, value))
+    return aliases
+
+
+## Supporting class: Union-find map of linked transaction ids, stored in a companion collection
+## Each alias document holds the alias's parent and, for a root, the number of aliases linked to it.
+## The root alias is the key of the canonical transaction. Unions by size keep the trees flat,
+## finding a root compresses the path, so lookups stay close to O(1) per event.
+## Loaded aliases are cached for the whole search, changed ones are marked dirty to be saved.
+#
+class AliasMap(object):
+    def __init__(self):
+        self.parent = {}
+        self.size   = {}
+        self.dirty  = set()
+
+    def load(self, aliases, fetch):
+        ## Load unknown aliases and their ancestors, one request per level of the trees
+        #
+        missing = set([alias for alias in aliases if alias not in self.parent])
+        while missing:
+            documents = fetch(missing)
+            parents   = set()
+            for alias in missing:
+                document = documents.get(alias)
+                if document is None:
+                    self.parent[alias] = alias
+                    self.size[alias]   = 1
+                    self.dirty.add(alias)
+                else:
+                    self.parent[alias] = document.get('parent', alias)
+                    self.size[alias]   = int(document.get('size', 1))
+                    parents.add(self.parent[alias])
+            missing = set([alias for alias in parents if alias not in self.parent])
+
+    def find(self, alias):
+        root = alias
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[alias] != root:
+            parent             = self.parent[alias]
+            self.parent[alias] = root
+            self.dirty.add(alias)
+            alias              = parent
+        return root
+
+    def union(self, aliases):
+        ## Links all aliases to one root, returns the roots which got linked to another one
+        #
+        linked = []
+        root   = self.find(aliases[0])
+        for alias in aliases[1:]:
+            other = self.find(alias)
+            if other == root:
+                continue
+            if self.size[other] > self.size[root]:
+                root, other = other, root
+            self.parent[other] = root
+            self.size[root]   += self.size[other]
+            self.dirty.update((root, other))
+            linked.append(other)
+        return linked
+
+    def dump(self):
+        documents  = [{'_key': alias, 'parent': self.find(alias), 'size': self.size[alias]} for alias in self.dirty]
+        self.dirty = set()
+        return documents
+
+
+## Supporting class: High-water mark of the events processed by earlier searches on a collection
+## Holds the latest event time processed and the checksums of the events at exactly that time.
+## Events older than the mark minus "lag" or already processed at the mark's time are dropped before any kv store lookup.
+## The mark is advanced by the events processed by this search and stored once the search completed.
+#
+class HighWaterMark(object):
+    key = 'hwm'
+
+    def __init__(self, document=None, lag=0):
+        document    = document or {}
+        self.lag    = lag * 1000000
+        self.time   = parse_time(document['time']) if document.get('time') is not None else None
+        self.hashes = set(document.get('hashes') or [])
+        self.next_time   = self.time
+        self.next_hashes = set(self.hashes)
+
+    def drops(self, event_time, digest):
+        if self.time is None:
+            return False
+        if event_time < self.time - self.lag:
+            return True
+        return event_time == self.time and digest in self.hashes
+
+    def observe(self, event_time, digest):
+        if self.next_time is None or event_time > self.next_time:
+            self.next_time   = event_time
+            self.next_hashes = set([digest])
+        elif event_time == self.next_time:
+            self.next_hashes.add(digest)
+
+    def dump(self):
+        return {'_key': self.key, 'time': format_time(self.next_time), 'hashes': sorted(self.next_hashes)}
+
+
 ## Supporting function: Treats object "iterable" as iterable tupel
 #
 def grouper(n, iterable):
@@ -21,15 +623,195 @@ def grouper(n, iterable):
        yield chunk
 
        
-def get_kv_entries(app, collection, sessionKey, transaction_id, id_list):
-    query                         = {"$or": id_list}
-    uri                           = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (app, collection, urllib.quote(json.dumps(query)))
-    serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey)
+## Supporting function: Retrieves the transactions stored under the given keys
+## The keys are sent in the body of a single batch_find POST request, thus there is no limit on the URL length
+#
+def find_kv_entries(app, collection, sessionKey, id_list):
+    query                         = [{"query": {"$or": [{"_key": id} for id in id_list]}}]
+    uri                           = '/servicesNS/nobody/%s/storage/collections/data/%s/batch_find' % (app, collection)
+    serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey, jsonargs=json.dumps(query))
     try:
         kvtransactions        = json.loads(serverContent)
     except:
+        kvtransactions        = None
+    if not isinstance(kvtransactions, list):
         raise ValueError("REST call returned invalid response. Presumably an invalid collection was provided: %s. Details: %s" % (collection, serverContent))
-    return {item[transaction_id]:collections.OrderedDict(item) for item in kvtransactions}
+    return {item['_key']:collections.OrderedDict(item) for result in kvtransactions for item in result}
+
+## Supporting function: Creates a transaction collection or completes its definition by numeric field types and accelerated fields
+## Returns the names of the fields and accelerated fields which got declared
+## Accelerated fields are posted as "accelerated_fields.<name>", the key collections.conf uses and the endpoint reports.
+## The SDK's create and update_index post "index.<name>" instead, which is why they are not used here.
+#
+def provision_collection(service, collection, transaction_id):
+    fields  = dict([(field, 'number') for field in NUMERIC_FIELDS] + [(transaction_id, 'string'), ('closed', 'bool')])
+    indexes = dict([(transaction_id, {transaction_id: 1})] + [('_'.join(index), collections.OrderedDict((field, 1) for field in index)) for index in INDEXED_FIELDS])
+
+    if collection not in service.kvstore:
+        settings = dict([('field.%s' % field, field_type) for field, field_type in fields.iteritems()] +
+                        [('accelerated_fields.%s' % name, json.dumps(index)) for name, index in indexes.iteritems()])
+        service.kvstore.post(name=collection, **settings)
+        return sorted(fields) + sorted(indexes)
+
+    declared = []
+    entity   = service.kvstore[collection]
+    for field, field_type in sorted(fields.iteritems()):
+        if entity.content.get('field.%s' % field) != field_type:
+            entity.update_field(field, field_type)
+            declared.append(field)
+    for name, index in sorted(indexes.iteritems()):
+        current = entity.content.get('accelerated_fields.%s' % name)
+        if not current or json.loads(current) != index:
+            entity.post(**{'accelerated_fields.%s' % name: json.dumps(index)})
+            declared.append(name)
+    return declared
+
+
+## Supporting function: Converts transactions saved by earlier versions, which keep _time and duration as strings and lack end_time
+## Reads them page by page ordered by _key and hands the converted documents to "saver", returns their number
+#
+def convert_legacy_transactions(app, collection, sessionKey, saver, page_size=1000):
+    converted = 0
+    after     = None
+    while True:
+        clauses = [{'end_time': None}]
+        if after is not None:
+            clauses.append({'_key': {'$gt': after}})
+        uri = '/servicesNS/nobody/%s/storage/collections/data/%s?sort=_key&limit=%s&query=%s' % (app, collection, page_size, urllib.quote(json.dumps({"$and": clauses})))
+        serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey)
+        if serverResponse.status != 200:
+            raise ValueError("REST call returned status %s while reading collection %s. Details: %s" % (serverResponse.status, collection, serverContent))
+        page = json.loads(serverContent, object_pairs_hook=collections.OrderedDict)
+
+        for document in page:
+            if document.get('_time') in (None, ''):
+                continue
+            start                  = parse_time(document['_time'])
+            end                    = start + parse_time(document.get('duration') or 0)
+            document['_time']      = time_seconds(start)
+            document['start_time'] = time_seconds(start)
+            document['end_time']   = time_seconds(end)
+            document['duration']   = time_seconds(end - start)
+            saver.add(document)
+            converted += 1
+
+        if len(page) < page_size:
+            return converted
+        after = page[-1]['_key']
+
+
+## Supporting function: Deletes documents from a collection by key
+## The query is sent in the URL, so callers pass at most DELETE_CHUNK_SIZE keys at once
+#
+def delete_kv_entries(app, collection, sessionKey, id_list):
+    query                         = {"$or": [{"_key": id} for id in id_list]}
+    uri                           = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (app, collection, urllib.quote(json.dumps(query)))
+    serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey, method='DELETE')
+    if serverResponse.status != 200:
+        raise ValueError("REST call returned status %s while deleting from collection %s. Details: %s" % (serverResponse.status, collection, serverContent))
+
+## Supporting class: Saves documents to a collection via batch_save while they are still being produced
+## Batches are limited by document count and serialized size, up to "workers" requests are in flight at once
+#
+class BatchSaver(object):
+    def __init__(self, app, collection, sessionKey, max_documents, max_bytes, workers):
+        self.uri           = '/servicesNS/nobody/%s/storage/collections/data/%s/batch_save' % (app, collection)
+        self.sessionKey    = sessionKey
+        self.max_documents = max_documents
+        self.max_bytes     = max_bytes
+        self.pool          = ThreadPool(workers)
+        self.slots         = threading.BoundedSemaphore(workers)
+        self.lock          = threading.Lock()
+        self.batch         = []
+        self.batch_bytes   = 2
+        self.saved         = 0
+        self.errors        = []
+
+    def add(self, document):
+        entry = json.dumps(document, sort_keys=True)
+        if self.batch and (len(self.batch) >= self.max_documents or self.batch_bytes + len(entry) + 1 > self.max_bytes):
+            self.flush()
+        self.batch.append(entry)
+        self.batch_bytes += len(entry) + 1
+
+    def flush(self):
+        if not self.batch:
+            return
+        entries          = '[%s]' % ','.join(self.batch)
+        count            = len(self.batch)
+        self.batch       = []
+        self.batch_bytes = 2
+
+        ## Block until one of the requests in flight has finished
+        #
+        self.slots.acquire()
+        self.pool.apply_async(self._save, (entries, count))
+
+    def close(self):
+        self.flush()
+        self.pool.close()
+        self.pool.join()
+        if self.errors:
+            raise RuntimeError("Failed to save %s batches to the kv store: %s" % (len(self.errors), self.errors[0]))
+
+    def _save(self, entries, count):
+        try:
+            for attempt in range(FETCH_ATTEMPTS):
+                try:
+                    serverResponse, serverContent = rest.simpleRequest(self.uri, sessionKey=self.sessionKey, jsonargs=entries)
+                except Exception as e:
+                    error = e
+                    continue
+                if serverResponse.status in (200, 201):
+                    with self.lock:
+                        self.saved += count
+                    return
+                error = "HTTP %s: %s" % (serverResponse.status, serverContent)
+            self.errors.append(error)
+        finally:
+            self.slots.release()
+
+
+## Supporting class: Tells for each field how its values get merged into a transaction
+##
+## mv_fields:     values are appended to a list capped at "mvmax" values, the latest value is remembered in "__latest_<field>"
+## latest_fields: the latest value replaces the stored one and is remembered in "__latest_<field>"
+## other_fields:  the stored value is kept, the event's value is only used if there is none
+## agg_fields:    additionally aggregated by the functions given in "agg"
+#
+class FieldPlan(object):
+    def __init__(self, transaction_id, mvlist, fieldnames, mvmax=None, agg=None):
+        self.skipped       = set([transaction_id, '_time', '_hashes']) | NON_IDENTITY_FIELDS
+        self.selected      = set(fieldnames or [])
+        self.mvlist        = mvlist
+        self.mvmax         = dict(mvmax or [])
+        self.agg           = agg or []
+        self.known         = set()
+        self.mv_fields     = []
+        self.latest_fields = []
+        self.other_fields  = []
+        self.agg_fields    = []
+
+        if not isinstance(mvlist, bool):
+            self.selected = set([field.strip() for field in mvlist.split(',')])
+
+    def update(self, fields):
+        for field in set(fields) - self.known:
+            self.known.add(field)
+            if field in self.skipped or field.startswith('__'):
+                continue
+
+            functions = [function for name, function in self.agg if name == field or name == '*']
+            if functions:
+                self.agg_fields.append((field, functions))
+
+            if self.selected and field not in self.selected:
+                self.other_fields.append(field)
+            elif self.mvlist or not isinstance(self.mvlist, bool):
+                self.mv_fields.append((field, "__latest_%s" % field, self.mvmax.get(field, self.mvmax.get('*'))))
+            else:
+                self.latest_fields.append((field, "__latest_%s" % field))
+
 
 @Configuration()
 class kvtransaction(StreamingCommand):
@@ -83,83 +865,354 @@ class kvtransaction(StreamingCommand):
           Note that values already written to a KV store will get deduplicated too.''',
         require=False, default=False, validate=validators.Boolean())
 
+    mvmax = Option(
+        doc='''
+        **Syntax:** **value=***<integer | list>*
+        **Description:** If **mvlist** is set, set **mvmax** to the maximum number of values kept per mvlist field.
+          Set to a comma-separated list of <field>:<integer> items to set the maximum per field, e.g. "url:100, user:10, 1000".
+          The number of values seen and the estimated number of distinct values are kept in "mvseen_<field>" and "mvdc_<field>".
+          Default is no limit.''',
+        require=False, validate=validators.FieldSpec(validators.Integer(1)))
+
+    mvpolicy = Option(
+        doc='''
+        **Syntax:** **value=***<first|last|reservoir>*
+        **Description:** Set **mvpolicy** to the values kept once **mvmax** is reached: the **first** values, the **last** values
+          or a **reservoir** sample of all values. Default is **last**.''',
+        require=False, default='last', validate=validators.Set(*MV_POLICIES))
+
+    agg = Option(
+        doc='''
+        **Syntax:** **value=***<list>*
+        **Description:** Set **agg** to a comma-separated list of <field>:<function> items to aggregate field values
+          incrementally into the field "<function>_<field>", e.g. "bytes:sum, status:last, user:dc, latency:max".
+          Supported functions are count, sum, min, max, first, last, dc, estdc, tdigest and top. estdc estimates the
+          distinct count from a HyperLogLog sketch of constant size (standard error about 3%). dc counts exactly up to
+          10000 distinct values, storing 8 bytes per value, and switches to the estimate of estdc above.
+          tdigest keeps a quantile sketch of numeric values to be expanded into percentiles by kvtransactionoutput.
+          top keeps the most frequent values in "top_<field>" and their guaranteed counts in "top_count_<field>".
+          Values are ranked by the guaranteed count, a lower bound of the true count.''',
+        require=False, validate=validators.FieldSpec(validators.Set(*AGGREGATE_FUNCTIONS)))
+
+    topk = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **topk** to the number of most frequent values listed by the top aggregate.
+          Applies to transactions created by this search. Default is **10**.''',
+        require=False, default=10, validate=validators.Integer(1, 1000))
+
+    topk_capacity = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **topk_capacity** to the number of counters of the Space-Saving summary kept by the top aggregate.
+          More counters make the counts of the listed values more accurate. Every value occurring in more than
+          1 / topk_capacity of a transaction's events is guaranteed to be counted. Default is ten times **topk**, at least **100**.''',
+        require=False, validate=validators.Integer(1, 100000))
+
+    perchunk = Option(
+        doc='''
+        **Syntax:** **value=***<bool>*
+        **Description:** Set **perchunk** to true to fetch, merge and save the stored transactions separately for every chunk of
+          events splunkd sends to the command. Memory use is bounded by the chunk size and results are returned while the search
+          is still running. A transaction spanning several chunks is returned once per chunk. Cannot be combined with
+          maxspan, maxpause, startswith and endswith, which need all events of the search in time order. Default is **false**.''',
+        require=False, default=False, validate=validators.Boolean())
+
+    fetch_size = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **fetch_size** to the maximum number of transaction ids looked up in the KV store per request.
+          Must not exceed the KV store's max_rows_per_query. Default is **5000**.''',
+        require=False, default=5000, validate=validators.Integer(1, 50000))
+
+    fetch_workers = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **fetch_workers** to the number of lookup requests sent to the KV store in parallel.
+          Limited to %s. Default is **1**.''' % MAX_FETCH_WORKERS,
+        require=False, default=1, validate=validators.Integer(1, MAX_FETCH_WORKERS))
+
+    save_size = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **save_size** to the maximum number of transactions saved to the KV store per request.
+          Must not exceed the KV store's max_documents_per_batch_save. Default is **1000**.''',
+        require=False, default=1000, validate=validators.Integer(1, 1000))
+
+    save_bytes = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **save_bytes** to the maximum size in bytes of the serialized transactions saved to the KV store per request.
+          Must not exceed the KV store's max_size_per_batch_save_mb. Default is **16777216**.''',
+        require=False, default=16777216, validate=validators.Integer(1))
+
+    save_workers = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **save_workers** to the number of save requests kept in flight while results are returned.
+          Limited to %s. Default is **2**.''' % MAX_SAVE_WORKERS,
+        require=False, default=2, validate=validators.Integer(1, MAX_SAVE_WORKERS))
+
+    show_unchanged = Option(
+        doc='''
+        **Syntax:** **value=***<bool>*
+        **Description:** Set **show_unchanged** to false to only return transactions which got created or updated by the search.
+          Unchanged transactions are never saved to the KV store again. Default is **true**.''',
+        require=False, default=True, validate=validators.Boolean())
+
+    dedup = Option(
+        doc='''
+        **Syntax:** **value=***<list|window|bloom>*
+        **Description:** Set **dedup** to the way checksums of events which already contributed to a transaction are stored.
+          **list** keeps all checksums, **window** keeps the latest **dedup_size** checksums,
+          **bloom** keeps a Bloom filter sized for **dedup_size** events with a false positive rate of **dedup_error**.
+          Should be the same for all searches writing to a collection. Default is **list**.''',
+        require=False, default='list', validate=validators.Set(*DEDUP_MODES))
+
+    dedup_size = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **dedup_size** to the number of checksums kept per transaction by **dedup=window**
+          or the number of events a Bloom filter is sized for by **dedup=bloom**. Default is **10000**.''',
+        require=False, default=10000, validate=validators.Integer(1))
+
+    dedup_error = Option(
+        doc='''
+        **Syntax:** **value=***<float>*
+        **Description:** Set **dedup_error** to the false positive rate of the Bloom filter used by **dedup=bloom**.
+          A false positive causes a new event to be skipped as duplicate. Default is **0.001**.''',
+        require=False, default=0.001, validate=validators.Float(0.000001, 0.5))
+
+    hash_fields = Option(
+        doc='''
+        **Syntax:** **value=***<list>*
+        **Description:** Set **hash_fields** to a comma-separated list of fields identifying an event, e.g. "_time, _cd, _raw".
+          Only these fields are used to calculate the checksum telling whether an event already contributed to a transaction.
+          Default are all fields except the ones calculated by kvtransaction.''',
+        require=False, validate=validators.List(validators.Fieldname()))
+
+    maxspan = Option(
+        doc='''
+        **Syntax:** **value=***<duration>*
+        **Description:** Set **maxspan** to close transactions whose events span more than the given duration, e.g. "1:00:00".
+          Closed transactions get "closed" set to true and "close_time" to the time they were closed at.''',
+        require=False, validate=validators.Duration())
+
+    maxpause = Option(
+        doc='''
+        **Syntax:** **value=***<duration>*
+        **Description:** Set **maxpause** to close transactions without events for the given duration, measured against
+          the latest event time seen by the search. Until then "close_time" holds the time the transaction will be closed at.
+          Pauses are found between the events of one search. An event older than a transaction's start arriving in a later
+          search extends the transaction without checking the pause before its start.''',
+        require=False, validate=validators.Duration())
+
+    startswith = Option(
+        doc='''
+        **Syntax:** **value=***<field>=<value>*
+        **Description:** Set **startswith** to close a transaction when an event matching the predicate arrives after its
+          latest event, e.g. "action=login". The value may contain wildcards.''',
+        require=False)
+
+    endswith = Option(
+        doc='''
+        **Syntax:** **value=***<field>=<value>*
+        **Description:** Set **endswith** to close a transaction with an event matching the predicate, e.g. "action=logout".
+          The value may contain wildcards.''',
+        require=False)
+
+    link_fields = Option(
+        doc='''
+        **Syntax:** **value=***<list>*
+        **Description:** Set **link_fields** to a comma-separated list of further id fields, e.g. "order_id, payment_id".
+          An event carrying several ids links them, events carrying any linked id are merged into one transaction
+          keyed by one of the linked ids. Ids of linked fields are prefixed by their field name, e.g. "order_id=123".''',
+        require=False, validate=validators.List(validators.Fieldname()))
+
+    link_collection = Option(
+        doc='''
+        **Syntax:** **value=***<collection>*
+        **Description:** Set **link_collection** to the collection keeping the links between ids used by **link_fields**.
+          Default is "<collection>_links".''',
+        require=False)
+
+    provision = Option(
+        doc='''
+        **Syntax:** **value=***<boolean>*
+        **Description:** Set **provision** to true to create the collection if it does not exist and to declare numeric
+          types for the timing fields and accelerated fields for the transaction id, start_time, end_time and closed.
+          The collections used by **link_fields** and **hwm** are created if they do not exist. Transactions saved by earlier
+          versions, which keep _time and duration as strings, are converted to the numeric timing fields once, so that
+          kvtransactionoutput's filters select them. Default is **false**.''',
+        require=False, default=False, validate=validators.Boolean())
+
+    hwm = Option(
+        doc='''
+        **Syntax:** **value=***<boolean>*
+        **Description:** Set **hwm** to true to keep a high-water mark of the latest event time processed in the collection
+          set by **hwm_collection**. Events older than the mark are dropped before looking up their transactions, which
+          makes overlapping time windows of scheduled searches cheap. Default is **false**.''',
+        require=False, default=False, validate=validators.Boolean())
+
+    hwm_lag = Option(
+        doc='''
+        **Syntax:** **value=***<duration>*
+        **Description:** Set **hwm_lag** to the duration events may arrive late, i.e. the delay between an event's time and
+          the time it gets searchable. Only events older than the high-water mark minus this duration are dropped, later
+          ones are deduplicated by their checksums as usual. Events arriving later than that are lost, the number of dropped
+          events is logged as a warning. Default is **3600** seconds.''',
+        require=False, default='3600', validate=validators.Duration())
+
+    hwm_collection = Option(
+        doc='''
+        **Syntax:** **value=***<collection>*
+        **Description:** Set **hwm_collection** to the collection keeping the high-water mark. Default is "<collection>_state".''',
+        require=False)
+
+    sessionize = Option(
+        doc='''
+        **Syntax:** **value=***<boolean>*
+        **Description:** Set **sessionize** to true to start a new generation of a transaction when an event arrives after
+          the transaction was closed by **maxspan**, **maxpause**, **startswith** or **endswith**. The previous generation
+          is finalized under the key "<transaction id>:<generation>", the new one keeps the transaction id as key.
+          Events older than the start of a later generation are dropped. Default is **false**.''',
+        require=False, default=False, validate=validators.Boolean())
+
+
 
+    _field_plan    = None
+    _closure_rules = None
+    _watermark     = None
+    _alias_map     = None
+    _high_water    = None
 
     def stream(self, events):
+        sessionKey = self.metadata.searchinfo.session_key
+        #self.logger.debug("Session Key2: %s" % str(sessionKey))
+        
+        if self.testmode:
+            self.logger.info("Test mode is activated. Will not write results to KV store")
+
+        hwm_collection = self.hwm_collection or '%s_state' % self.collection
+
+        ## Provision the collections before any documents get written
+        #
+        if self.provision and not self.testmode:
+            uri     = urlparse.urlsplit(self.metadata.searchinfo.splunkd_uri)
+            service = client.Service(scheme=uri.scheme, host=uri.hostname, port=uri.port, token="Splunk %s" % sessionKey, owner='nobody', app=self.app)
+            declared = provision_collection(service, self.collection, self.transaction_id)
+            self.logger.info("Provisioned collection %s, declared: %s" % (self.collection, ', '.join(declared) or 'nothing'))
+
+            ## Convert transactions of earlier versions once, kvtransactionoutput's filters compare the numeric timing fields
+            #
+            saver     = BatchSaver(self.app, self.collection, sessionKey, self.save_size, self.save_bytes, self.save_workers)
+            converted = convert_legacy_transactions(self.app, self.collection, sessionKey, saver)
+            saver.close()
+            if converted:
+                self.logger.info("Converted %s transactions saved by earlier versions to numeric timing fields" % converted)
+            for collection, used in ((self.link_collection or '%s_links' % self.collection, self.link_fields), (hwm_collection, self.hwm)):
+                if used and collection not in service.kvstore:
+                    service.kvstore.create(collection)
+                    self.logger.info("Created collection %s" % collection)
+
+        ## Load the high-water mark left by earlier searches
+        #
+        if self.hwm:
+            document = find_kv_entries(self.app, hwm_collection, sessionKey, [HighWaterMark.key]).get(HighWaterMark.key)
+            self._high_water = HighWaterMark(document, self.hwm_lag or 0)
+            self.logger.info("Loaded high-water mark: %s" % (document or {}).get('time'))
+
+        ## Process each chunk on its own or the whole search at once
+        #
+        if self.perchunk and self.protocol_version == 2:
+            for chunk in events:
+                self.logger.info("Processing chunk of %s incoming events." % len(chunk))
+                for event in self.merge_events(chunk, sessionKey):
+                    yield event
+        else:
+            for event in self.merge_events(events, sessionKey):
+                yield event
+
+        ## Advance the high-water mark only after all transactions got saved
+        ## Events do not arrive in time order, so the mark must not move while the search is running
+        #
+        if self.hwm and not self.testmode and self._high_water.next_time is not None:
+            saver = BatchSaver(self.app, hwm_collection, sessionKey, 1, self.save_bytes, 1)
+            saver.add(self._high_water.dump())
+            saver.close()
+            self.logger.info("Saved high-water mark: %s" % format_time(self._high_water.next_time))
+
+
+    def merge_events(self, events, sessionKey):
         """                                             """
         """   Initialize event independent variables.   """
         """                                             """
         
         event_list       = []
-        results_list     = []
-        id_list          = []
-        field_list       = []
+        event_keys       = []
+        event_times      = []
+        id_list          = set()
         key_list         = set()
+        dirty_keys       = set()
+        linked_keys      = []
+        state_dict       = {}
         transaction_dict = {}
 
-        sessionKey = self.metadata.searchinfo.session_key
-        #self.logger.debug("Session Key2: %s" % str(sessionKey))
-        
-        
-        if self.testmode:
-            self.logger.info("Test mode is activated. Will not write results to KV store")
+        high_water       = self._high_water
+        dropped          = 0
+        late             = 0
 
         ## Aggregate events, distinct fieldnames and distinct transaction IDs
-        ## Calculate event checksums while doing so
+        ## Calculate event checksums and parse event times while doing so, drop events behind the high-water mark
         #
         self.logger.info("Starting to preprocess incoming events.")
+        now = int(time.time() * 1000000)
         for event in events:
-            hashable_event = event
-            try:
-                del hashable_event['_key']
-                del hashable_event['event_count']
-                del hashable_event['duration']
-                del hashable_event['start_time']
-                del hashable_event['_hashes']
-                
-                for key in hashable_event:
-                    if '__latest_' in key:
-                        del hashable_event[key]
-            except:
-                pass
-            event['_hashes'] = str(hashlib.md5(json.dumps(hashable_event)).hexdigest())
-
-            try:
-                id_list.append({self.transaction_id: event[self.transaction_id]})
-            except KeyError:
-                pass
-            event_list.append(event)
+            event['_hashes'] = fingerprint(event, self.hash_fields)
+            event_time       = parse_time(event['_time']) if event.get('_time') else now
 
-            for key in event.keys():
-                key_list.add(key)
+            if high_water is not None and event.get('_time'):
+                if high_water.drops(event_time, event['_hashes']):
+                    dropped += 1
+                    continue
+                high_water.observe(event_time, event['_hashes'])
+
+            if self.link_fields:
+                aliases = event_aliases(event, self.transaction_id, self.link_fields)
+                if not aliases:
+                    continue
+                id_list.update(aliases)
+                event_keys.append(aliases)
+            else:
+                try:
+                    id_list.add(event[self.transaction_id])
+                except KeyError:
+                    continue
+                event_keys.append(event[self.transaction_id])
+            event_list.append(event)
+            event_times.append(event_time)
+            key_list.update(event)
 
-        id_list  = {v[self.transaction_id]:v for v in id_list}.values()
-        key_list = list(key_list)
         self.logger.info("Finished preprocessing %s incoming events with %s unique transaction ids" % (len(event_list), len(id_list)))
+        if dropped:
+            self.logger.warning("Dropped %s events older than the high-water mark minus hwm_lag" % dropped)
 
         ## Set mvlist behavior for all relevant fields
+        ## The plan is kept for the whole search and only extended by fields not seen before
         #
-        if isinstance(self.mvlist, bool):
-            if self.fieldnames:
-                field_list = self.fieldnames
-            else:
-                field_list = list(key_list)
-
-        elif not isinstance(self.mvlist, bool):
-            field_list = [i.strip() for i in self.mvlist.split(',')]
+        if self._field_plan is None:
+            self._field_plan = FieldPlan(self.transaction_id, self.mvlist, self.fieldnames, self.mvmax, self.agg)
+        plan = self._field_plan
+        plan.update(key_list)
 
-            ## Adjust field_list to actually available fieldnames
-            #
-            for i in field_list:
-                contained = False
-                
-                if i in key_list:
-                    contained = True
-                    
-                if not contained:
-                    field_list = [item for item in field_list if not i]
-                else:
-                    pass            
+        if self._closure_rules is None:
+            self._closure_rules = ClosureRules(self.maxspan, self.maxpause, self.startswith, self.endswith)
+        rules = self._closure_rules
+        if self.sessionize and not rules:
+            raise ValueError('The argument "sessionize" requires maxspan, maxpause, startswith or endswith to be set.')
+        if self.perchunk and rules:
+            raise ValueError('The argument "perchunk" cannot be combined with maxspan, maxpause, startswith or endswith, '
+                             'which need all events of the search in time order.')
 
 
         """                                                             """
@@ -167,143 +1220,333 @@ class kvtransaction(StreamingCommand):
         """ Process events and calculate new transaction properties.    """
         """                                                             """
 
+        ## Load the transaction (orderedDict) with the given key and its state, create a new one if there is none
+        #
+        def load_transaction(key, transaction_id):
+            doc   = transaction_dict.get(key)
+            state = state_dict.get(key)
+            if doc is None:
+                doc                   = collections.OrderedDict()
+                doc[self.transaction_id] = transaction_id
+                transaction_dict[key] = doc
+            if state is None:
+                state           = TransactionState(doc, load_dedup(doc.get('_hashes'), self.dedup, self.dedup_size, self.dedup_error))
+                state_dict[key] = state
+            return doc, state
+
         if len(id_list) > 0:
-            ## Set maximum length for kv store requests
-            #
-            self.logger.info("Retrieving relevant stored transactions.")
-            max_query_len = 2000 - len(self.collection)
-        
-            ## Directly request if limit is not reached
+            ## Link all ids carried by the same event and key each event by the root of its ids
+            ## The transactions of roots linked to another root have to be merged into the other root's transaction
             #
-            if len(str(id_list)) < max_query_len:
-                transaction_dict = get_kv_entries(self.app, self.collection, sessionKey, self.transaction_id, id_list)
-            ## Else request in appropriate chunks
+            if self.link_fields:
+                if self._alias_map is None:
+                    self._alias_map = AliasMap()
+                alias_map = self._alias_map
+                alias_map.load(id_list, lambda aliases: self.fetch_transactions(aliases, sessionKey, self.link_collection or '%s_links' % self.collection))
+                for aliases in event_keys:
+                    linked_keys.extend(alias_map.union(aliases))
+                event_keys = [alias_map.find(aliases[0]) for aliases in event_keys]
+                id_list    = set(event_keys) | set(linked_keys)
+                self.logger.info("Linked ids to %s transactions, %s transactions got linked to another one." % (len(set(event_keys)), len(linked_keys)))
+
+            ## Request the stored transactions in chunks of fetch_size ids and merge the responses
             #
-            else:
-                len_list   = [len(str(id[self.transaction_id])) for id in id_list]
-                length     = 0
-                last_index = 0
-
-                for index, element in enumerate(len_list):
-                    if max_query_len < length + element:
-                        transaction_dict = get_kv_entries(self.app, self.collection, sessionKey, self.transaction_id, id_list[last_index:index])                        
-                        length           = element
-                        last_index       = index
-                    else:
-                        length     = length + element
-                    ## Trigger condition for the last chunk, since it might never reach the size neccessary for triggering a request otherwise
-                    #
-                    if index == len(len_list):
-                        transaction_dict.update(get_kv_entries(self.app, self.collection, sessionKey, self.transaction_id, id_list[last_index:index]))
+            self.logger.info("Retrieving relevant stored transactions.")
+            transaction_dict = self.fetch_transactions(id_list, sessionKey)
             self.logger.info("Retrieved %s stored transactions." % (len(transaction_dict)))
 
-            ## Process events
+            ## Merge the stored transactions of linked roots into the transaction of their new root and delete them
+            #
+            deleted_keys = []
+            for linked_key in linked_keys:
+                linked_doc = transaction_dict.pop(linked_key, None)
+                if linked_doc is None:
+                    continue
+                key        = self._alias_map.find(linked_key)
+                doc, state = load_transaction(key, linked_doc.get(self.transaction_id, key))
+                self.merge_transactions(plan, doc, state, linked_doc,
+                    TransactionState(linked_doc, load_dedup(linked_doc.get('_hashes'), self.dedup, self.dedup_size, self.dedup_error)))
+                state_dict.pop(linked_key, None)
+                doc['_key'] = key
+                dirty_keys.add(key)
+                deleted_keys.append(linked_key)
+
+            ## Process events in time order, splunkd usually sends them newest first
+            ## Closing and splitting transactions compares each event with the events merged before
             #
             self.logger.info("Start processing events")
-            for event in event_list:
-                ## Buffer KV store entry (transaction) correspondig with the current event as orderedDict
+            ordered_events = sorted(itertools.izip(event_times, event_list, event_keys), key=lambda item: item[0])
+            for event_time, event, key in ordered_events:
+                ## Merge the event into the stored transaction (orderedDict) corresponding with the current event or a new one
+                ## Load the transaction's state from the stored transaction when it is first seen
                 #
-                kvevent     = transaction_dict.get(event[self.transaction_id], {})
-                kv_max_time = Decimal(kvevent.get('_time',0)) + Decimal(kvevent.get('duration',0))
-                try:
-                    event_time = Decimal(event['_time'])
-                except KeyError:
-                    event_time = Decimal(time.time()).quantize(Decimal('.000001'), rounding=ROUND_DOWN)
-                #self.logger.debug("Corresponding KV event: %s." % kvevent)
+                doc, state = load_transaction(key, event.get(self.transaction_id, key))
+                if self._watermark is None or event_time > self._watermark:
+                    self._watermark = event_time
+                #self.logger.debug("Corresponding KV event: %s." % doc)
 
                 
                 ## Check if the event already contributed to the transaction
                 ## If so, skip further processing entirely
                 #
-                kvhashes = kvevent.get('_hashes', [])
-                if not isinstance(kvhashes, list):
-                    kvhashes = [kvhashes]
-                if event['_hashes'] in kvhashes:
-                    #self.logger.debug("Skipped processing for event with ID %s." % event[self.transaction_id])
+                if event['_hashes'] in state.dedup:
+                    #self.logger.debug("Skipped processing for event with ID %s." % key)
                     continue
-                else:
-                    kvhashes.append(event['_hashes'])
-                    event['_hashes'] = kvhashes
+
+                ## An event older than the start of a later generation belongs to a finalized generation, drop it
+                ## Only a later search can deliver such an event, events of one search are merged in time order
+                #
+                if self.sessionize and state.start is not None and event_time < state.start and int(doc.get('generation', 0)) > 0:
+                    late += 1
+                    continue
+
+                ## Finalize the current generation under a derived key and start a new one, if the event arrives after it closed
+                ## The new generation keeps its own checksums, events of earlier generations are recognized by their time
+                #
+                if self.sessionize and rules.splits(state, event, event_time):
+                    generation = int(doc.get('generation', 0))
+                    if state.close is None:
+                        state.close = min(rules.deadline(state) or event_time, event_time)
+                    final_key                   = '%s:%d' % (key, generation)
+                    doc['_key']                 = final_key
+                    transaction_dict[final_key] = doc
+                    state_dict[final_key]       = state
+                    dirty_keys.add(final_key)
+
+                    doc                   = collections.OrderedDict()
+                    doc[self.transaction_id] = key
+                    doc['generation']     = generation + 1
+                    transaction_dict[key] = doc
+                    state                 = TransactionState(doc, load_dedup(None, self.dedup, self.dedup_size, self.dedup_error))
+                    state_dict[key]       = state
+
+                state.dedup.add(event['_hashes'])
+
+                ## A value of the event replaces the latest value, if the event is the transaction's latest or there is no value yet
+                #
+                is_latest = state.end is None or event_time > state.end
 
 
                 ## Determine the transaction's new field values
                 #
-                if self.mvlist or not isinstance(self.mvlist, bool):                                           
-                    for field in field_list:
-                        if field == self.transaction_id or field == '_time' or field == '_hashes' or '__latest_' in field:
-                            continue
+                for field, latest_field, mvmax in plan.mv_fields:
+                    field_value = event.get(field)
+                    if field_value:
+                        ## Control deduplication and limits by accumulating the values in a UniqueList or BoundedList
+                        #
+                        kvfield = state.mv.get(field)
+                        if kvfield is None:
+                            kvfield = state.load_mv(doc, field, self.mvdedup, mvmax, self.mvpolicy)
+                        if isinstance(field_value, list):
+                            kvfield.extend(field_value)
                         else:
-                            kvfield      = kvevent.get(field, [])
-                            latest_field = "__latest_%s" % field
-                            field_value  = event.get(field, "")
-                            if not isinstance(kvfield, list):
-                                kvfield = [kvfield]
-                            if field_value and len(field_value) > 0:
-                                kvfield.append(field_value)
-                                if event_time > kv_max_time or kv_max_time == '0' or kvevent.get(latest_field, "") == '':
-                                    event[latest_field] = field_value
-                                else:
-                                    event[latest_field] = kvevent.get(latest_field, "")
-                            else:
-                                event[latest_field] = kvevent.get(latest_field, "")
-                                
-                            ## Control deduplication
-                            #
-                            if self.mvdedup:
-                                kvfield = list(set(kvfield))
-                            event[field] = kvfield
-
-                if not self.mvlist:
-                    for field in field_list:
-                        if field == self.transaction_id or field == '_time' or field == '_hashes' or '__latest_' in field:
-                            continue
-                        else:
-                            kvfield      = kvevent.get(field, [])
-                            latest_field = "__latest_%s" % field
-                            field_value  = event.get(field, "")
-                            if field_value and len(field_value) > 0:
-                                if event_time > kv_max_time or kv_max_time == '0' or kvevent.get(latest_field, "") == '':
-                                    kvfield             = field_value
-                                    event[latest_field] = field_value
-                                else:
-                                    kvfield             = kvevent.get(latest_field, "")
-                                    event[latest_field] = kvevent.get(latest_field, "")
-                            #else:
-                            #    kvfield             = kvevent.get(latest_field, "")
-                            #    event[latest_field] = kvevent.get(latest_field, "")
-                            event[field] = kvfield
+                            kvfield.append(field_value)
+                        if is_latest or not doc.get(latest_field):
+                            doc[latest_field] = field_value
+
+                for field, latest_field in plan.latest_fields:
+                    field_value = event.get(field)
+                    if field_value and (is_latest or not doc.get(latest_field)):
+                        doc[field]        = field_value
+                        doc[latest_field] = field_value
 
+                for field, functions in plan.agg_fields:
+                    field_value = event.get(field)
+                    if field_value:
+                        aggregates = state.agg.get(field)
+                        if aggregates is None:
+                            aggregates = state.load_agg(doc, field, functions, self.topk, self.topk_capacity)
+                        for aggregate in aggregates:
+                            aggregate.add(field_value, event_time)
+
+                ## Keep stored values of all other fields, add the event's value if there is none
+                #
+                for field in plan.other_fields:
+                    if field not in doc and field in event:
+                        doc[field] = event[field]
+
+
+                ## Close the transaction at its deadline, if the event arrives after a pause longer than maxpause or beyond maxspan,
+                ## otherwise by the event matching startswith or endswith. Events are in time order, so every pause is seen
+                #
+                if rules and state.close is None:
+                    deadline = rules.deadline(state) if state.end is not None else None
+                    if deadline is not None and event_time > deadline:
+                        state.close = deadline
+                    elif state.end is not None and event_time > state.end and rules.starts(event):
+                        state.close = event_time
+                    elif rules.ends(event):
+                        state.close = event_time
 
                 ## Calculate the transaction's new properties
                 #
-                for kvfield in kvevent:
-                    if not kvfield in field_list:
-                        event.update({kvfield:kvevent[kvfield]})
-                current_min_time                = min(Decimal(kvevent.get('_time','inf')), event_time)
-                current_max_time                = max(kv_max_time, event_time)
-                event_count                     = int(kvevent.get('event_count',0)) + 1
-                event['start_time']             = str(current_min_time)
-                event['duration']               = str(current_max_time - current_min_time)
-                event['event_count']            = event_count
-                event['_time']                  = str(current_min_time)
-                event['_key']                   = event[self.transaction_id]
-                transaction_dict[event['_key']] = event
+                state.add(event_time)
+                doc['_key'] = key
+                dirty_keys.add(key)
+
+            if late:
+                self.logger.warning("Dropped %s events older than the start of a later generation of their transaction" % late)
 
             ## Yield the correct events for each transaction ID
+            ## Push created or updated ones into the KV store in the background while doing so
             #
-            self.logger.info("Displaying results in splunk")
+            saver = None
+            if not self.testmode and dirty_keys:
+                saver = BatchSaver(self.app, self.collection, sessionKey, self.save_size, self.save_bytes, self.save_workers)
+
+            self.logger.info("Displaying results in splunk and saving %s of %s transactions to kv store" % (len(dirty_keys), len(transaction_dict)))
             for transaction in transaction_dict:
                 event = transaction_dict.get(transaction, {})
-                yield event
-                results_list.append(event)
-                
-        ## Push into KV store piecemeal in 1000 item chunks, if transactions got updated or created
+                if transaction in dirty_keys:
+                    state_dict[transaction].dump(event)
+                    if rules:
+                        state_dict[transaction].dump_closure(event, rules, self._watermark)
+                    yield event
+                    if saver:
+                        saver.add(event)
+                elif self.show_unchanged:
+                    yield event
+
+            ## Wait for the remaining batches to be saved
+            #
+            if saver:
+                saver.close()
+                self.logger.info("Saved %s transactions to kv store" % saver.saved)
+
+            ## Save the changed links only after the transactions they point to, then delete the merged transactions
+            #
+            if not self.testmode and self.link_fields:
+                links = self._alias_map.dump()
+                if links:
+                    link_saver = BatchSaver(self.app, self.link_collection or '%s_links' % self.collection, sessionKey, self.save_size, self.save_bytes, self.save_workers)
+                    for link in links:
+                        link_saver.add(link)
+                    link_saver.close()
+                    self.logger.info("Saved %s links to kv store" % link_saver.saved)
+                for group in grouper(DELETE_CHUNK_SIZE, deleted_keys):
+                    delete_kv_entries(self.app, self.collection, sessionKey, group)
+                if deleted_keys:
+                    self.logger.info("Deleted %s transactions merged into linked ones from kv store" % len(deleted_keys))
+
+
+    def merge_transactions(self, plan, doc, state, other, other_state):
+        ## Extend the plan by the fields of both stored transactions, the events linking them may carry none of them
+        ## Event fields are recognized by their "__latest_<field>", aggregated ones by their stored aggregates
+        #
+        fields = set()
+        for document in (doc, other):
+            fields.update([field[len('__latest_'):] for field in document if field.startswith('__latest_')])
+            fields.update([field for field, function in plan.agg if field != '*' and
+                           ('%s_%s' % (function, field) in document or '__%s_%s' % (function, field) in document)])
+        plan.update(fields)
+
+        ## Merge mvlist fields and aggregates by their accumulators, they are written to the transaction when dumping its state
+        #
+        for field, latest_field, mvmax in plan.mv_fields:
+            values = other.get(field)
+            if values:
+                kvfield = state.mv.get(field)
+                if kvfield is None:
+                    kvfield = state.load_mv(doc, field, self.mvdedup, mvmax, self.mvpolicy)
+                kvfield.extend(values if isinstance(values, list) else [values])
+
+        for field, functions in plan.agg_fields:
+            if not any('%s_%s' % (function, field) in other or '__%s_%s' % (function, field) in other for function in functions):
+                continue
+            aggregates = state.agg.get(field)
+            if aggregates is None:
+                aggregates = state.load_agg(doc, field, functions, self.topk, self.topk_capacity)
+            for aggregate in aggregates:
+                aggregate.merge(Aggregate(aggregate.function, field, other, self.topk, self.topk_capacity))
+
+        ## Keep the values of all other fields, take over the latest values if the other transaction ended later
+        #
+        is_latest = other_state.end is not None and (state.end is None or other_state.end > state.end)
+        for field, value in other.iteritems():
+            if field in NON_IDENTITY_FIELDS or field in state.mv or field in ('_time', '_user', self.transaction_id):
+                continue
+            if field not in doc or (is_latest and (field.startswith('__latest_') or '__latest_%s' % field in other)):
+                doc[field] = value
+
+        state.merge(other_state)
+
+    def fetch_transactions(self, id_list, sessionKey, collection=None):
+        transaction_dict = {}
+        groups           = list(grouper(self.fetch_size, id_list))
+        failed_groups    = 0
+
+        ## Request a single chunk of ids, retrying on failure
+        ## Errors are handed back instead of raised to not abort the other chunks
         #
-        if results_list and not self.testmode:
-            self.logger.info("Saving results to kv store")
-            for group in grouper(1000, results_list):
-                entries                       = json.dumps(group, sort_keys=True)
-                uri                           = '/servicesNS/nobody/%s/storage/collections/data/%s/batch_save' % (self.app, self.collection)
-                rest.simpleRequest(uri, sessionKey=sessionKey, jsonargs=entries)
+        def fetch(group):
+            error = None
+            for attempt in range(FETCH_ATTEMPTS):
+                try:
+                    return group, find_kv_entries(self.app, collection or self.collection, sessionKey, group), None
+                except Exception as e:
+                    error = e
+            return group, None, error
+
+        ## Send the requests on a thread pool if more than one worker is allowed
+        #
+        workers = min(self.fetch_workers, len(groups))
+        pool    = ThreadPool(workers) if workers > 1 else None
+        try:
+            if pool:
+                results = pool.imap_unordered(fetch, groups)
+            else:
+                results = itertools.imap(fetch, groups)
+
+            for group, entries, error in results:
+                if error is not None:
+                    failed_groups += 1
+                    self.logger.error("Failed to retrieve %s stored transactions after %s attempts: %s" % (len(group), FETCH_ATTEMPTS, error))
+                else:
+                    transaction_dict.update(entries)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        ## Never merge events into incomplete stored transactions, since saving them would discard the stored values
+        #
+        if failed_groups > 0:
+            raise RuntimeError("Failed to retrieve %s of %s chunks of stored transactions from collection %s. See kvtransaction.log for details." % (failed_groups, len(groups), self.collection))
+        return transaction_dict
+
+
+    def _records_protocol_v2(self, ifile):
+        ## Hand over the records of each chunk as a list if perchunk is set
+        ## The list is complete before the response to the chunk is flushed and the next chunk is read
+        #
+        if not self.perchunk:
+            for record in StreamingCommand._records_protocol_v2(self, ifile):
+                yield record
+            return
+
+        while True:
+            result = self._read_chunk(ifile)
+
+            if not result:
+                return
+
+            metadata, body = result
+            action = getattr(metadata, 'action', None)
+
+            if action != 'execute':
+                raise RuntimeError('Expected execute action, not {}'.format(action))
+
+            finished = getattr(metadata, 'finished', False)
+            self._record_writer.is_flushed = False
+
+            ## The body of a chunk is formatted just like the input of protocol v1
+            #
+            if len(body) > 0:
+                yield list(self._records_protocol_v1(StringIO(body)))
+
+            if finished:
+                return
+
+            self.flush()
 
 dispatch(kvtransaction, sys.argv, sys.stdin, sys.stdout, __name__)
@@ -1,14 +1,255 @@
 #!/usr/bin/env python
 
-import sys, json, collections, itertools, urllib, re
+import sys, os, json, collections, itertools, urllib, re, time, gzip, tempfile, threading, Queue
 import splunk.rest as rest
 import splunklib.client as client
 
+from kvsketch import TDigest
+from multiprocessing.pool import ThreadPool
 from decimal import *
 from datetime import timedelta, datetime
 from splunklib.searchcommands import \
     dispatch, GeneratingCommand, Configuration, Option, validators
 
+
+## Hard limit for the size of a single request to the index and for the number of export workers
+#
+MAX_SUBMIT_BYTES   = 8388608
+MAX_EXPORT_WORKERS = 8
+
+## Number of keys per delete request, keeping the query within the maximum URL length
+#
+DELETE_CHUNK_SIZE  = 100
+
+## Ways of writing transactions to an index
+#
+OUTPUT_MODES = ('rest', 'spool')
+
+## Sourcetype with line breaking for batches of transactions, configured in default/props.conf
+#
+BATCH_SOURCETYPE = 'kvtransaction'
+
+
+## Supporting function: Reads the documents matching the filter page by page, ordered by _key
+## Each page starts after the last key of the previous one, so the KV store's row limit per query never truncates the result
+## and pages stay consistent while documents get deleted. The next page is requested in the background.
+#
+def iter_kv_pages(app, collection, sessionKey, filter, page_size):
+    def fetch(after):
+        clauses = list(filter)
+        if after is not None:
+            clauses.append({'_key': {'$gt': after}})
+        uri = '/servicesNS/nobody/%s/storage/collections/data/%s?sort=_key&limit=%s' % (app, collection, page_size)
+        if clauses:
+            uri += '&query=%s' % urllib.quote(json.dumps({"$and": clauses}))
+        serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey)
+        if serverResponse.status != 200:
+            raise ValueError("REST call returned status %s while reading collection %s. Details: %s" % (serverResponse.status, collection, serverContent))
+        return json.loads(serverContent, object_pairs_hook=collections.OrderedDict)
+
+    pool = ThreadPool(1)
+    try:
+        page = fetch(None)
+        while page:
+            pending = pool.apply_async(fetch, (page[-1]['_key'],)) if len(page) >= page_size else None
+            yield page
+            page    = pending.get() if pending else None
+    finally:
+        pool.close()
+        pool.join()
+
+
+## Supporting function: Deletes the given transactions from a collection, in requests of DELETE_CHUNK_SIZE keys
+## A transaction is only deleted if its event count did not change since it was read, updated ones are kept.
+## A kept transaction has already been exported and is exported again by the next move, so the index holds it twice.
+#
+def delete_kv_entries(app, collection, sessionKey, entries):
+    for offset in range(0, len(entries), DELETE_CHUNK_SIZE):
+        clauses = []
+        for key, event_count in entries[offset:offset + DELETE_CHUNK_SIZE]:
+            clauses.append({'_key': key} if event_count is None else {'_key': key, 'event_count': event_count})
+        uri = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (app, collection, urllib.quote(json.dumps({"$or": clauses})))
+        serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey, method='DELETE')
+        if serverResponse.status != 200:
+            raise ValueError("REST call returned status %s while deleting from collection %s. Details: %s" % (serverResponse.status, collection, serverContent))
+
+
+## Supporting class: Collects the transactions acknowledged by the export and deletes them in requests of DELETE_CHUNK_SIZE keys
+## Exporting threads add their keys concurrently, a full chunk is deleted by the thread completing it.
+## Small batches are collected across batches, "close" deletes the remainder.
+#
+class KeyDeleter(object):
+    def __init__(self, app, collection, sessionKey):
+        self.app        = app
+        self.collection = collection
+        self.sessionKey = sessionKey
+        self.entries    = []
+        self.deleted    = 0
+        self.lock       = threading.Lock()
+
+    def _take(self, size):
+        with self.lock:
+            taken        = self.entries[:size]
+            self.entries = self.entries[size:]
+        return taken
+
+    def _delete(self, entries):
+        delete_kv_entries(self.app, self.collection, self.sessionKey, entries)
+        with self.lock:
+            self.deleted += len(entries)
+
+    def __call__(self, entries):
+        with self.lock:
+            self.entries.extend(entries)
+            full = len(self.entries) // DELETE_CHUNK_SIZE * DELETE_CHUNK_SIZE
+        if full:
+            self._delete(self._take(full))
+
+    def close(self):
+        remainder = self._take(None)
+        if remainder:
+            self._delete(remainder)
+
+
+## Supporting class: Submits events to an index via REST, one request per batch of newline separated events
+## Every sink owns its connection
+#
+class IndexSink(object):
+    def __init__(self, index, **metadata):
+        self.index    = index
+        self.metadata = metadata
+
+    def __call__(self, batch):
+        self.index.submit(''.join(batch), **self.metadata)
+
+
+## Supporting function: Returns the directory spool files are written to before being moved into spool_dir
+## Defaults to "kvtransaction_staging" next to spool_dir, so the input monitoring spool_dir never sees incomplete files.
+## Both have to be on the same file system for the rename to be atomic.
+#
+def staging_directory(spool_dir, staging_dir=None):
+    staging_dir = staging_dir or os.path.join(os.path.dirname(os.path.normpath(spool_dir)), 'kvtransaction_staging')
+    try:
+        os.makedirs(staging_dir)
+    except OSError:
+        if not os.path.isdir(staging_dir):
+            raise
+    if os.stat(staging_dir).st_dev != os.stat(spool_dir).st_dev:
+        raise ValueError('The staging directory %s is not on the file system of spool_dir %s. Set staging_dir to a directory '
+                         'on the same file system which is not monitored by any input.' % (staging_dir, spool_dir))
+    return staging_dir
+
+
+## Supporting class: Writes batches of events to files in a spool directory to be indexed by the local Splunk instance
+## Each file starts with a ***SPLUNK*** header setting index, host, source and sourcetype.
+## Files are written to a temporary file in the staging directory first and renamed into the spool directory when complete.
+#
+class SpoolSink(object):
+    def __init__(self, directory, staging, compress, worker=0, **metadata):
+        self.directory = directory
+        self.staging   = staging
+        self.compress  = compress
+        self.worker    = worker
+        self.files     = 0
+        self.header    = '***SPLUNK*** %s\n' % ' '.join(['%s=%s' % (key, '"%s"' % value if ' ' in str(value) else value)
+                                                        for key, value in sorted(metadata.iteritems()) if value])
+
+    def __call__(self, batch):
+        name = 'kvtransaction_%d_%d_%d_%d%s' % (time.time() * 1000, os.getpid(), self.worker, self.files, '.gz' if self.compress else '.log')
+        handle, temp = tempfile.mkstemp(prefix='.kvtransaction_', suffix='.tmp', dir=self.staging)
+        try:
+            with os.fdopen(handle, 'wb') as spool:
+                out = gzip.GzipFile(name, 'wb', 6, spool) if self.compress else spool
+                out.write(self.header)
+                for event in batch:
+                    out.write(event.encode('utf-8') if isinstance(event, unicode) else event)
+                if self.compress:
+                    out.close()
+            os.rename(temp, os.path.join(self.directory, name))
+            temp = None
+        finally:
+            ## Failing to clean up must not hide the error which stopped the file from being completed
+            #
+            if temp:
+                try:
+                    os.remove(temp)
+                except OSError:
+                    pass
+        self.files += 1
+
+
+## Supporting class: Collects events into batches limited by event count and size and hands them to the sinks
+## With more than one sink every sink runs on its own thread, pulling batches from a bounded queue.
+## Adding events blocks while the queue is full, so reading the collection never runs far ahead of the export.
+## "acknowledge" is called with the keys of each batch exported successfully, on the thread which exported it.
+#
+class BatchSubmitter(object):
+    def __init__(self, sinks, batch_size, acknowledge=None):
+        self.batch_size  = batch_size
+        self.acknowledge = acknowledge
+        self.batch       = []
+        self.keys        = []
+        self.bytes       = 0
+        self.submitted   = 0
+        self.errors      = []
+        self.lock        = threading.Lock()
+        self.sink        = sinks[0] if len(sinks) == 1 else None
+        self.queue       = Queue.Queue(2 * len(sinks))
+        self.threads     = [threading.Thread(target=self._work, args=(sink,)) for sink in sinks] if self.sink is None else []
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _submit(self, sink, batch, keys):
+        ## Errors are collected instead of raised to keep the other batches going
+        #
+        try:
+            sink(batch)
+            if self.acknowledge:
+                self.acknowledge(keys)
+        except Exception as e:
+            with self.lock:
+                self.errors.append(e)
+        else:
+            with self.lock:
+                self.submitted += len(batch)
+
+    def _work(self, sink):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            self._submit(sink, *item)
+
+    def add(self, event, key=None):
+        event = "%s\n\n" % event
+        if self.batch and (len(self.batch) >= self.batch_size or self.bytes + len(event) > MAX_SUBMIT_BYTES):
+            self.flush()
+        self.batch.append(event)
+        self.keys.append(key)
+        self.bytes += len(event)
+
+    def flush(self):
+        if not self.batch:
+            return
+        if self.sink is not None:
+            self._submit(self.sink, self.batch, self.keys)
+        else:
+            self.queue.put((self.batch, self.keys))
+        self.batch = []
+        self.keys  = []
+        self.bytes = 0
+
+    def close(self):
+        self.flush()
+        for thread in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.errors:
+            raise RuntimeError("Failed to export %s batches of transactions: %s" % (len(self.errors), self.errors[0]))
+
+
 @Configuration()
 class outputkvtransaction(GeneratingCommand):
     """ %(synopsis)
@@ -64,6 +305,13 @@ class outputkvtransaction(GeneratingCommand):
         **Syntax:** **value=***<string>*
         **Description:** Filter by field used as status for the transaction.''',
         require=False)
+
+    closed = Option(
+        doc='''
+        **Syntax:** **value=***<boolean>*
+        **Description:** Set **closed** to true to select transactions closed by kvtransaction's closure rules
+          (maxspan, maxpause, startswith, endswith) or whose "close_time" has passed. Set to false to select open transactions.''',
+        require=False, validate=validators.Boolean())
         
     testmode = Option(
         doc='''
@@ -98,13 +346,15 @@ class outputkvtransaction(GeneratingCommand):
     sourcetype = Option(
         doc='''
         **Syntax:** **value=***<sourcetype>*
-        **Description:** Set **sourcetype** to the value you want the sourcetype field to hold.''',
+        **Description:** Set **sourcetype** to the value you want the sourcetype field to hold. Defaults to the collection,
+          or to **kvtransaction** with **batch_size** greater than 1 or **output_mode=spool**.''',
         require=False)
         
     action = Option(
         doc='''
         **Syntax:** **value=***<copy|move|flush>*
-        **Description:** Set **action** to copy, move or flush. Default's to move''',
+        **Description:** Set **action** to copy, move or flush. Default's to move. move keeps transactions updated by
+          kvtransaction while being exported, the next move exports them again, so the index holds both versions.''',
         require=True, default='move')
 
     collection = Option(
@@ -125,6 +375,66 @@ class outputkvtransaction(GeneratingCommand):
         **Description:** Set **index** to the index to write to.''',
         require=True)
 
+    output_mode = Option(
+        doc='''
+        **Syntax:** **value=***<rest|spool>*
+        **Description:** Set **output_mode** to spool to write transactions to files in **spool_dir** indexed by the local
+          Splunk instance instead of submitting them to **splunk_server** via REST. Default is **rest**.''',
+        require=False, default='rest', validate=validators.Set(*OUTPUT_MODES))
+
+    spool_dir = Option(
+        doc='''
+        **Syntax:** **value=***<path>*
+        **Description:** Set **spool_dir** to the directory spool files are written to by **output_mode=spool**.
+          It has to be monitored by a batch input. Files are written to **staging_dir** first and renamed into this
+          directory when complete. Default is $SPLUNK_HOME/var/spool/splunk.''',
+        require=False)
+
+    staging_dir = Option(
+        doc='''
+        **Syntax:** **value=***<path>*
+        **Description:** Set **staging_dir** to the directory spool files are written to until they are complete. It has to be
+          on the file system of **spool_dir** and must not be monitored by any input. Created if missing.
+          Default is "kvtransaction_staging" next to **spool_dir**.''',
+        require=False)
+
+    compress = Option(
+        doc='''
+        **Syntax:** **value=***<boolean>*
+        **Description:** Set **compress** to false to write uncompressed spool files. Default is **true**.''',
+        require=False, default=True, validate=validators.Boolean())
+
+    workers = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **workers** to the number of batches exported in parallel, each worker using its own connection.
+          Default is **1**.''',
+        require=False, default=1, validate=validators.Integer(1, MAX_EXPORT_WORKERS))
+
+    batch_size = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **batch_size** to the number of transactions submitted to the index per request.
+          With **output_mode=spool** set to the number of transactions per spool file. Values above 1 require the
+          sourcetype to break events at every line break (SHOULD_LINEMERGE = false, LINE_BREAKER = ([\\r\\n]+)) where
+          the events get parsed, otherwise a whole batch may become one event. The app ships these settings for
+          sourcetype=kvtransaction. Default is **1**.''',
+        require=False, default=1, validate=validators.Integer(1))
+
+    page_size = Option(
+        doc='''
+        **Syntax:** **value=***<integer>*
+        **Description:** Set **page_size** to the number of transactions read from the collection per request.
+          Must not exceed the KV store's max_rows_per_query. Default is **10000**.''',
+        require=False, default=10000, validate=validators.Integer(1, 50000))
+
+    percentiles = Option(
+        doc='''
+        **Syntax:** **value=***<list>*
+        **Description:** Set **percentiles** to a comma-separated list of percentiles, e.g. "50, 95, 99", to expand
+          the quantile sketches kept by kvtransaction's tdigest aggregates into the fields "p<percentile>_<field>".''',
+        require=False, validate=validators.List(validators.Float(0, 100)))
+
 
         
     def generate(self):
@@ -136,8 +446,17 @@ class outputkvtransaction(GeneratingCommand):
             self.host       = self.splunk_server
         if not self.source:
             self.source     = self.collection
+
+        ## Several transactions per request or file are only split into single events by a sourcetype breaking at every line,
+        ## default to the one configured in props.conf and warn about others
+        #
+        batched = self.batch_size > 1 or self.output_mode == 'spool'
         if not self.sourcetype:
-            self.sourcetype = self.collection
+            self.sourcetype = BATCH_SOURCETYPE if batched else self.collection
+        elif batched and self.sourcetype != BATCH_SOURCETYPE:
+            self.write_warning('Sourcetype {0} needs SHOULD_LINEMERGE = false and LINE_BREAKER = ([\\r\\n]+) where events get parsed, '
+                               'otherwise batches of transactions become single events. sourcetype={1} is configured this way.',
+                               self.sourcetype, BATCH_SOURCETYPE)
 
 
         """                                       """
@@ -155,145 +474,139 @@ class outputkvtransaction(GeneratingCommand):
         if self.closed_txn:
             filter.append({'closed_txn': str(self.closed_txn)})
             
+        ## Both clauses for closed transactions compare "closed" by equality, so each is served by the (closed, close_time) index
+        #
+        if self.closed is not None:
+            now = time.time()
+            if self.closed:
+                filter.append({'$or': [{'closed': True}, {'closed': False, 'close_time': {'$lte': now}}]})
+            else:
+                filter.append({'closed': {'$ne': True}})
+                filter.append({'$or': [{'close_time': {'$gt': now}}, {'close_time': None}]})
+
         if self.minevents:
             filter.append({'event_count': {'$gte': int(self.minevents)}})
             
         if self.minduration:
-            filter.append({'duration': {'$gte': str(self.minduration)}})
+            filter.append({'duration': {'$gte': int(self.minduration)}})
 
         if self.minstartdaysago:
             delta      = timedelta(days=self.minstartdaysago)
             timefilter = current_time - delta
-            filter.append({'_time': {'$lte': str((timefilter - datetime(1970,1,1)).total_seconds())}})
+            filter.append({'start_time': {'$lte': (timefilter - datetime(1970,1,1)).total_seconds()}})
+
+        if self.minenddaysago:
+            delta      = timedelta(days=self.minenddaysago)
+            timefilter = current_time - delta
+            filter.append({'end_time': {'$lte': (timefilter - datetime(1970,1,1)).total_seconds()}})
 
         """
         ## TODO: Currently not working. Yields 'query invalid', even when modifying the not statement.
         #
         if self.transaction_id:
             filter.append({str(self.transaction_id): {'$not': ''}})
-          
-             
-        ## TODO: This parameter is not supported atm since the transaction's duration has to be known
-        ## Current behaviour is equal to minstartdaysago
-        #
-        if self.minenddaysago:
-            delta      = timedelta(days=self.minenddaysago)
-            timefilter = current_time - delta
-            filter.append({'_time': {'$lt': timefilter.strftime('%Y-%d-%d %H:%M:%S.%f')}})
         """
         
         query = {"$and": filter}
 
 
-        ## Get kv store entries according to the set parameters
+        ## Check the action before reading anything
         #
-        #self.logger.debug("Filter for transaction ids: %s." % query)
-        if len(filter) > 0:
-            uri = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (self.app, self.collection, urllib.quote(json.dumps(query)))
-        else:
-            uri = '/servicesNS/nobody/%s/storage/collections/data/%s' % (self.app, self.collection)
-        serverResponse, serverContent = rest.simpleRequest(uri, sessionKey=sessionKey)
-        transactions                  = json.loads(serverContent)
-        transactions_dict             = {item['_key']:collections.OrderedDict(item) for item in transactions}
-            
-        ## Print retrieved events
+        action = str(self.action)
+        if re.match(r'(copy|move|flush)', action) is None:
+            raise ValueError('The argument "action" is invalid: %s. Set to copy, move or flush.' % self.action)
+
+        ## Open connection to the index to copy or move data read from collection to
         #
-        for transaction in transactions_dict:
-            #self.logger.debug("Transaction: %s." % transaction)
-            yield transactions_dict.get(transaction, {})
+        submitter = None
+        if not self.testmode and re.match(r'(copy|move)', action):
+            metadata = dict(host=self.host, source=self.source, sourcetype=self.sourcetype)
+            sinks    = []
+            if self.output_mode == 'spool':
+                spool_dir = self.spool_dir or os.path.join(os.environ['SPLUNK_HOME'], 'var', 'spool', 'splunk')
+                staging   = staging_directory(spool_dir, self.staging_dir)
+            for worker in range(self.workers):
+                if self.output_mode == 'spool':
+                    sinks.append(SpoolSink(spool_dir, staging, self.compress, worker, index=self.index, **metadata))
+                else:
+                    token   = ("Splunk %s" % sessionKey)
+                    service = client.connect(host=self.splunk_server, port=self.splunkd_port, token=token)
+                    sinks.append(IndexSink(service.indexes[self.index], **metadata))
+
+            ## Move deletes exactly the transactions exported successfully, collected into chunks across batches
+            #
+            deleter = None
+            if re.match(r'move', action):
+                deleter = KeyDeleter(self.app, self.collection, sessionKey)
+            submitter = BatchSubmitter(sinks, self.batch_size, deleter)
+
 
-            
         """                                        """
-        """   Copy / move / delete transactions.   """
+        """   Print and copy transactions.         """
         """                                        """
-        
-        ## Perform according to the set action if testmode is not true
+
+        ## Get kv store entries according to the set parameters page by page, the next page is read while the current one is processed
         #
-        if not self.testmode:
-            if re.match(r'copy', str(self.action)):
-                ## Open connection and copy data read from collection to index
+        #self.logger.debug("Filter for transaction ids: %s." % query)
+        for page in iter_kv_pages(self.app, self.collection, sessionKey, filter, self.page_size):
+            for transaction in page:
+                ## Expand quantile sketches into the requested percentiles
                 #
-                token   = ("Splunk %s" % sessionKey)
-                service = client.connect(host=self.splunk_server, port=self.splunkd_port, token=token)
-                index   = service.indexes[self.index]
-                #socket  = index.attach(host=self.host, source=self.source, sourcetype=self.sourcetype)
-
-                for transaction in transactions_dict:
-                    data = transactions_dict.get(transaction, {})
-                    del data['_key']
-                    del data['_user']
-                    del data['_hashes']
-                    try:
-                        del data['tag_txn']
-                    except:
-                        pass
-                    try:
-                        del data['closed_txn']
-                    except:
-                        pass
-                    for key in data:
-                        if '__latest_' in key:
-                            del data[key]
-
-                    json_data = json.dumps(data, sort_keys=True)
-                    #socket.send("%s\n\n" % json_data)
-                    #socket.send("\n")
-                    index.submit("%s\n\n" % json_data, host=self.host, source=self.source, sourcetype=self.sourcetype)
-                #socket.close()
-
-            elif re.match(r'move', str(self.action)):
-                ## Open connection and copy data read from collection to index
+                if self.percentiles:
+                    for key in [key for key in transaction if key.startswith('__tdigest_')]:
+                        digest = TDigest.load(transaction[key])
+                        for percentile in self.percentiles:
+                            transaction['p%g_%s' % (percentile, key[len('__tdigest_'):])] = digest.quantile(percentile / 100.0)
+
+                ## Print retrieved events
                 #
-                token   = ("Splunk %s" % sessionKey)
-                service = client.connect(host=self.splunk_server, port=self.splunkd_port, token=token)
-                index   = service.indexes[self.index]
-
-                for transaction in transactions_dict:
-                    data = transactions_dict.get(transaction, {})
-                    del data['_key']
-                    del data['_user']
-                    del data['_hashes']
-                    try:
-                        del data['tag_txn']
-                    except:
-                        pass
-                    try:
-                        del data['closed_txn']
-                    except:
-                        pass
-                    for key in data:
-                        if '__latest_' in key:
-                            del data[key]
-                            
-                    json_data = json.dumps(data, sort_keys=True)
-                    index.submit("%s\n\n" % json_data, host=self.host, source=self.source, sourcetype=self.sourcetype)
-
-                ## Remove read data from collection
-                ## TODO: Create a list of _key after filtering above and do this by key?
-                ##       Only neccessary if filtering by transaction_id and/or minenddaysago will be implemented.
+                #self.logger.debug("Transaction: %s." % transaction)
+                yield transaction
+
+                ## Copy to index without the fields only used in the collection
                 #
-                if len(filter) > 0:
-                    uri = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (self.app, self.collection, urllib.quote(json.dumps(query)))
-                else:
-                    uri = '/servicesNS/nobody/%s/storage/collections/data/%s' % (self.app, self.collection)
-                rest.simpleRequest(uri, sessionKey=sessionKey, method='DELETE')
+                if submitter is not None:
+                    entry = (transaction.get('_key'), transaction.get('event_count'))
+                    for key in list(transaction):
+                        if key in ('_key', '_user', '_hashes', 'tag_txn', 'closed_txn') or key.startswith('__'):
+                            del transaction[key]
 
-            elif re.match(r'flush', str(self.action)):
-                ## Remove read data from collection
+                    submitter.add(json.dumps(transaction, sort_keys=True), entry)
+
+        ## Submit the last batch and wait for all batches to be exported
+        #
+        if submitter is not None:
+            failed = True
+            try:
+                submitter.close()
+                failed = False
+            finally:
+                ## Transactions exported before an error are deleted all the same, so the next move does not export them again.
+                ## A failing delete is only logged then, to raise the export error
                 #
-                if len(filter) > 0:
-                    uri = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (self.app, self.collection, urllib.quote(json.dumps(query)))
-                else:
-                    uri = '/servicesNS/nobody/%s/storage/collections/data/%s' % (self.app, self.collection)
-                rest.simpleRequest(uri, sessionKey=sessionKey, method='DELETE')
+                if deleter is not None:
+                    try:
+                        deleter.close()
+                    except Exception as e:
+                        if not failed:
+                            raise
+                        self.logger.error("Failed to delete exported transactions from collection %s: %s" % (self.collection, e))
+            self.logger.info("Exported %s transactions to index %s" % (submitter.submitted, self.index))
+            if deleter is not None:
+                self.logger.info("Deleted %s exported transactions from collection %s" % (deleter.deleted, self.collection))
 
-            else:
-                raise ValueError('The argument "action" is invalid: %s. Set to copy, move or flush.' % self.action)
 
-        elif self.testmode and re.match(r'(copy|move|flush)', str(self.action)) is None:
-            raise ValueError('The argument "action" is invalid: %s. Set to copy, move or flush.' % self.action)
+        """                                        """
+        """   Delete transactions.                 """
+        """                                        """
 
-        else:
-            pass
+        ## Remove read data from collection if testmode is not true
+        #
+        if not self.testmode and re.match(r'flush', action):
+            if len(filter) > 0:
+                uri = '/servicesNS/nobody/%s/storage/collections/data/%s?query=%s' % (self.app, self.collection, urllib.quote(json.dumps(query)))
+            else:
+                uri = '/servicesNS/nobody/%s/storage/collections/data/%s' % (self.app, self.collection)
+            rest.simpleRequest(uri, sessionKey=sessionKey, method='DELETE')
 
 dispatch(outputkvtransaction, sys.argv, sys.stdin, sys.stdout, __name__)
\ No newline at end of file
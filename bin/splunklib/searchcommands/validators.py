@@ -423,5 +423,59 @@ class BoolOrList(Validator):
             return None if value is None else 't' if value else 'f'
         else:
             return None if value is None else 'list'
-            
-__all__ = ['Boolean', 'Code', 'Duration', 'File', 'Integer', 'List', 'Map', 'RegularExpression', 'Set']
+
+
+## Custom validator accepting a comma-separated list of [<fieldname>:]<value> items, e.g. "user:100, url:20, 50"
+## Returns a list of (fieldname, value) tuples. Items without a fieldname apply to all fields and get the fieldname "*".
+#
+class FieldSpec(Validator):
+    def __init__(self, validator=None):
+        self._validator = validator
+
+    def __call__(self, value):
+        if value is None or isinstance(value, list):
+            return value
+        items = []
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            field, _, spec = item.strip().rpartition(':')
+            field = field.strip() or '*'
+            if field != '*' and Fieldname.pattern.match(field) is None:
+                raise ValueError('Illegal characters in fieldname: {}'.format(field))
+            spec = spec.strip()
+            if self._validator is not None:
+                spec = self._validator(spec)
+            items.append((field, spec))
+        return items
+
+    def format(self, value):
+        if value is None:
+            return None
+        return ','.join(['{}'.format(spec) if field == '*' else '{}:{}'.format(field, spec) for field, spec in value])
+
+
+## Custom validator accepting floating point values, optionally within a range
+#
+class Float(Validator):
+    def __init__(self, minimum=None, maximum=None):
+        self.minimum = minimum
+        self.maximum = maximum
+
+    def __call__(self, value):
+        if value is None:
+            return None
+        try:
+            value = float(value)
+        except ValueError:
+            raise ValueError('Expected float value, not {}'.format(json_encode_string(value)))
+        if self.minimum is not None and value < self.minimum:
+            raise ValueError('Expected float not less than {0}, not {1}'.format(self.minimum, value))
+        if self.maximum is not None and value > self.maximum:
+            raise ValueError('Expected float not greater than {0}, not {1}'.format(self.maximum, value))
+        return value
+
+    def format(self, value):
+        return None if value is None else unicode(float(value))
+
+__all__ = ['Boolean', 'Code', 'Duration', 'File', 'Integer', 'List', 'Map', 'RegularExpression', 'Set', 'FieldSpec', 'Float']
@@ -0,0 +1,225 @@
+## Tests of the summary structures in bin/kvsketch.py
+##
+## Run with: python -m unittest discover -s tests
+#
+
+import bisect, collections, hashlib, os, random, sys, unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+from kvsketch import BloomFilter, HyperLogLog, DigestSet, TDigest, SpaceSaving, load_dedup, merge_dedup
+
+
+class TestBloomFilter(unittest.TestCase):
+    def digests(self, prefix, count):
+        return [hashlib.md5('%s%d' % (prefix, i)).hexdigest() for i in xrange(count)]
+
+    def test_contains_added(self):
+        bloom = BloomFilter.create(1000, 0.01)
+        added = self.digests('a', 1000)
+        for digest in added:
+            bloom.add(digest)
+        for digest in added:
+            self.assertTrue(digest in bloom)
+
+    def test_false_positive_rate(self):
+        bloom = BloomFilter.create(5000, 0.01)
+        for digest in self.digests('a', 5000):
+            bloom.add(digest)
+        false_positives = sum([1 for digest in self.digests('b', 20000) if digest in bloom])
+        self.assertLess(false_positives / 20000.0, 0.02)
+
+    def test_dump_load(self):
+        bloom = BloomFilter.create(100, 0.001)
+        for digest in self.digests('a', 100):
+            bloom.add(digest)
+        loaded = load_dedup(bloom.dump(), 'bloom')
+        self.assertEqual((loaded.bits, loaded.hashes, loaded.data), (bloom.bits, bloom.hashes, bloom.data))
+
+    def test_merge(self):
+        first, second = BloomFilter.create(200, 0.01), BloomFilter.create(200, 0.01)
+        for digest in self.digests('a', 100):
+            first.add(digest)
+        for digest in self.digests('b', 100):
+            second.add(digest)
+        merged = merge_dedup(first, second)
+        for digest in self.digests('a', 100) + self.digests('b', 100):
+            self.assertTrue(digest in merged)
+
+
+class TestHyperLogLog(unittest.TestCase):
+    def test_error_bound(self):
+        ## Three standard errors of 1.04 / sqrt(1024)
+        #
+        for count in (100, 5000, 100000):
+            sketch = HyperLogLog()
+            for i in xrange(count):
+                sketch.add('value%d' % i)
+            self.assertLess(abs(sketch.estimate() - count), 3 * 0.0325 * count + 1)
+
+    def test_dump_load(self):
+        sketch = HyperLogLog()
+        for i in xrange(1000):
+            sketch.add(i)
+        loaded = HyperLogLog.load(sketch.dump())
+        self.assertEqual(loaded.registers, sketch.registers)
+        self.assertEqual(loaded.estimate(), sketch.estimate())
+
+    def test_merge(self):
+        first, second, union = HyperLogLog(), HyperLogLog(), HyperLogLog()
+        for i in xrange(3000):
+            first.add(i)
+            union.add(i)
+        for i in xrange(2000, 6000):
+            second.add(i)
+            union.add(i)
+        first.merge(second)
+        self.assertEqual(first.registers, union.registers)
+
+
+class TestDigestSet(unittest.TestCase):
+    def test_exact_below_limit(self):
+        digests = DigestSet(limit=100)
+        for i in xrange(200):
+            digests.add(i % 50)
+        self.assertEqual(len(digests), 50)
+        self.assertEqual(len(DigestSet.load(digests.dump(), 100)), 50)
+
+    def test_converts_above_limit(self):
+        digests = DigestSet(limit=100)
+        for i in xrange(5000):
+            digests.add(i)
+        self.assertTrue(digests.dump().startswith(HyperLogLog.prefix))
+        self.assertLess(abs(len(digests) - 5000), 3 * 0.0325 * 5000)
+        self.assertEqual(len(DigestSet.load(digests.dump(), 100)), len(digests))
+
+    def test_merge_exact_into_sketch(self):
+        first, second = DigestSet(limit=100), DigestSet(limit=100)
+        for i in xrange(1000):
+            first.add(i)
+        for i in xrange(900, 950):
+            second.add(i)
+        estimate = len(first)
+        second.merge(first)
+        self.assertEqual(len(second), estimate)
+
+
+class TestTDigest(unittest.TestCase):
+    def values(self, seed, count):
+        generator = random.Random(seed)
+        return [generator.expovariate(1.0) for i in xrange(count)]
+
+    def assertQuantiles(self, digest, values):
+        values = sorted(values)
+        for q in (0.01, 0.1, 0.5, 0.9, 0.99, 0.999):
+            rank = bisect_rank(values, digest.quantile(q)) / float(len(values))
+            self.assertLess(abs(rank - q), 0.01, 'quantile %s at rank %s' % (q, rank))
+
+    def test_error_bound(self):
+        values = self.values(1, 50000)
+        digest = TDigest()
+        for value in values:
+            digest.add(value)
+        self.assertQuantiles(digest, values)
+        self.assertEqual(digest.quantile(0), min(values))
+        self.assertEqual(digest.quantile(1), max(values))
+
+    def test_size_bounded(self):
+        digest = TDigest()
+        for value in self.values(2, 50000):
+            digest.add(value)
+        digest.compress()
+        self.assertLessEqual(len(digest.centroids), digest.compression)
+
+    def test_dump_load(self):
+        digest = TDigest()
+        for value in self.values(3, 5000):
+            digest.add(value)
+        loaded = TDigest.load(digest.dump())
+        self.assertEqual(loaded.centroids, digest.centroids)
+        self.assertEqual((loaded.minimum, loaded.maximum), (digest.minimum, digest.maximum))
+        self.assertEqual(len(loaded), 5000)
+
+    def test_empty(self):
+        ## A field whose values are not numeric yet leaves the digest empty
+        #
+        for stored in (TDigest().dump(), 'tdigest:200:None:None:'):
+            loaded = TDigest.load(stored)
+            self.assertEqual(len(loaded), 0)
+            self.assertEqual(loaded.quantile(0.5), None)
+            loaded.add(3)
+            self.assertEqual(TDigest.load(loaded.dump()).quantile(0.5), 3.0)
+
+    def test_merge(self):
+        first_values, second_values = self.values(4, 20000), self.values(5, 20000)
+        first, second = TDigest(), TDigest()
+        for value in first_values:
+            first.add(value)
+        for value in second_values:
+            second.add(value)
+        merged = TDigest.load(first.dump())
+        merged.merge(TDigest.load(second.dump()))
+        self.assertEqual(len(merged), 40000)
+        self.assertQuantiles(merged, first_values + second_values)
+
+
+class TestSpaceSaving(unittest.TestCase):
+    def values(self, seed, count):
+        generator = random.Random(seed)
+        return ['v%d' % int(generator.paretovariate(1.0)) for i in xrange(count)]
+
+    def assertBounds(self, summary, counts):
+        for item, (count, error) in summary.counters.iteritems():
+            self.assertTrue(count - error <= counts[item] <= count, '%s: %s' % (item, [count, error, counts[item]]))
+
+    def test_error_bound(self):
+        values  = self.values(1, 20000)
+        counts  = collections.Counter(values)
+        summary = SpaceSaving(5, 50)
+        for value in values:
+            summary.add(value)
+        self.assertBounds(summary, counts)
+        ## Every value occurring more often than total / capacity is kept
+        #
+        for item, count in counts.iteritems():
+            if count > len(values) / 50.0:
+                self.assertTrue(item in summary.counters)
+        self.assertEqual([item for item, count in summary.top()], [item for item, count in counts.most_common(5)])
+
+    def test_top_guaranteed(self):
+        summary = SpaceSaving(2, 2)
+        for value in ['a', 'a', 'a', 'b', 'c', 'd']:
+            summary.add(value)
+        ## d replaced c and inherited its count as error, so a and d rank by 3 and 1
+        #
+        self.assertEqual(summary.top(), [('a', 3), ('d', 1)])
+
+    def test_dump_load(self):
+        summary = SpaceSaving(5, 50)
+        for value in self.values(2, 5000):
+            summary.add(value)
+        loaded = SpaceSaving.load(summary.dump())
+        self.assertEqual((loaded.size, loaded.capacity, loaded.counters), (summary.size, summary.capacity, summary.counters))
+
+    def test_merge(self):
+        first_values, second_values = self.values(3, 10000), self.values(4, 10000)
+        first, second = SpaceSaving(5, 30), SpaceSaving(5, 30)
+        for value in first_values:
+            first.add(value)
+        for value in second_values:
+            second.add(value)
+        first.merge(second)
+        counts = collections.Counter(first_values + second_values)
+        self.assertLessEqual(len(first.counters), 30)
+        self.assertBounds(first, counts)
+        self.assertEqual([item for item, count in first.top(3)], [item for item, count in counts.most_common(3)])
+
+
+## Supporting function: Returns the number of sorted values less than or equal to value
+#
+def bisect_rank(values, value):
+    return bisect.bisect_right(values, value)
+
+
+if __name__ == '__main__':
+    unittest.main()
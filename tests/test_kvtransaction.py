@@ -0,0 +1,215 @@
+## Tests of merging events into transactions by the kvtransaction command
+##
+## The kv store is replaced by collections held in memory, which are emptied before every test.
+## Run with: python -m unittest discover -s tests
+#
+
+import json, os, sys, types, unittest, urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'bin'))
+
+## Supporting module: splunk.rest is only available inside Splunk
+## Answers the batch_find, batch_save, query and delete requests of kvtransaction from STORE
+#
+STORE = {}
+
+
+class Response(object):
+    status = 200
+
+
+def matches(document, query):
+    for field, condition in query.iteritems():
+        if field == '$and':
+            if not all([matches(document, clause) for clause in condition]):
+                return False
+        elif isinstance(condition, dict):
+            for operator, value in condition.iteritems():
+                if operator == '$gt' and not document.get(field) > value:
+                    return False
+        elif document.get(field) != condition:
+            return False
+    return True
+
+
+def simple_request(uri, sessionKey=None, jsonargs=None, method='GET', **kwargs):
+    path, _, query = uri.partition('?')
+    parts          = path.split('/')
+    collection     = STORE.setdefault(parts[parts.index('data') + 1], {})
+    arguments      = dict(urlparse.parse_qsl(query))
+    if path.endswith('/batch_find'):
+        keys = [clause['_key'] for clause in json.loads(jsonargs)[0]['query']['$or']]
+        return Response(), json.dumps([[collection[key] for key in keys if key in collection]])
+    elif path.endswith('/batch_save'):
+        documents = json.loads(jsonargs)
+        for document in documents:
+            collection[document['_key']] = document
+        return Response(), json.dumps([document['_key'] for document in documents])
+    elif method == 'DELETE':
+        for clause in json.loads(arguments['query'])['$or']:
+            collection.pop(clause['_key'], None)
+        return Response(), ''
+    elif method == 'GET':
+        found = [collection[key] for key in sorted(collection) if matches(collection[key], json.loads(arguments.get('query', '{}')))]
+        return Response(), json.dumps(found[:int(arguments.get('limit', 0)) or None])
+    raise ValueError('Unexpected request: %s %s' % (method, uri))
+
+
+splunk                    = types.ModuleType('splunk')
+splunk.rest               = types.ModuleType('splunk.rest')
+splunk.rest.simpleRequest = simple_request
+sys.modules.setdefault('splunk', splunk)
+sys.modules.setdefault('splunk.rest', splunk.rest)
+
+from kvtransaction import kvtransaction, BoundedList, HighWaterMark, BatchSaver, convert_legacy_transactions
+from splunklib.searchcommands.internals import CommandLineParser
+
+
+## Supporting function: Runs kvtransaction with the given arguments on the events and returns the transactions by key
+#
+def run(args, events):
+    command = kvtransaction()
+    CommandLineParser.parse(command, ['transaction_id=tid', 'collection=test'] + args)
+    return dict([(transaction['_key'], transaction) for transaction in command.merge_events([dict(event) for event in events], 'session')])
+
+
+## Supporting function: Merges events of one transaction at the given times
+#
+def merge(args, times, transaction_id='a'):
+    return run(args, [{'_time': str(event_time), 'tid': transaction_id, 'n': str(index)} for index, event_time in enumerate(times)])
+
+
+class StoreTestCase(unittest.TestCase):
+    def setUp(self):
+        STORE.clear()
+
+
+class TestEventOrder(StoreTestCase):
+    ## splunkd sends events newest first, the results must not depend on the order
+    #
+    times = [1000, 1020, 1300, 1310]
+
+    def test_sessionize_newest_first(self):
+        for times in (self.times, list(reversed(self.times))):
+            transactions = merge(['testmode=true', 'maxpause=60', 'sessionize=true'], times)
+            self.assertEqual(sorted(transactions), ['a', 'a:0'])
+            self.assertEqual((transactions['a:0']['start_time'], transactions['a:0']['end_time']), (1000.0, 1020.0))
+            self.assertEqual(transactions['a:0']['closed'], True)
+            self.assertEqual(transactions['a:0']['close_time'], 1080.0)
+            self.assertEqual((transactions['a']['start_time'], transactions['a']['end_time']), (1300.0, 1310.0))
+            self.assertEqual(transactions['a']['event_count'], 2)
+            self.assertEqual(transactions['a']['generation'], 1)
+
+    def test_maxpause_newest_first(self):
+        ## The pause between the second and third event closes the transaction, even though later events follow
+        #
+        for times in (self.times, list(reversed(self.times))):
+            transaction = merge(['testmode=true', 'maxpause=60'], times)['a']
+            self.assertEqual((transaction['start_time'], transaction['end_time']), (1000.0, 1310.0))
+            self.assertEqual(transaction['closed'], True)
+            self.assertEqual(transaction['close_time'], 1080.0)
+
+    def test_perchunk_rejected(self):
+        self.assertRaises(ValueError, merge, ['testmode=true', 'maxpause=60', 'perchunk=true'], self.times)
+
+    def test_maxspan_newest_first(self):
+        for times in (self.times, list(reversed(self.times))):
+            transaction = merge(['testmode=true', 'maxspan=200'], times)['a']
+            self.assertEqual(transaction['closed'], True)
+            self.assertEqual(transaction['close_time'], 1200.0)
+
+
+class TestBoundedList(unittest.TestCase):
+    def test_counts_stored_list_before_truncating(self):
+        ## A stored list without counters, e.g. written before mvmax was set, is counted completely
+        #
+        for policy in ('first', 'last', 'reservoir'):
+            values = BoundedList(['v%d' % index for index in range(10)], 3, policy)
+            document = {}
+            values.dump(document, 'f')
+            self.assertEqual(len(document['f']), 3)
+            self.assertEqual(document['mvseen_f'], 10)
+            self.assertEqual(document['mvdc_f'], 10)
+
+    def test_keeps_stored_counters(self):
+        values = BoundedList(['a', 'b', 'c'], 2, 'last', seen=7)
+        values.append('d')
+        self.assertEqual(list(values), ['c', 'd'])
+        self.assertEqual(values.seen, 8)
+
+
+class TestGenerations(StoreTestCase):
+    args = ['maxpause=60', 'sessionize=true']
+
+    def test_checksums_not_inherited(self):
+        merge(self.args, [100, 120])
+        merge(self.args, [900])
+        merge(self.args, [1700])
+        self.assertEqual(sorted(STORE['test']), ['a', 'a:0', 'a:1'])
+        self.assertEqual(STORE['test']['a']['generation'], 2)
+        self.assertEqual(len(STORE['test']['a']['_hashes']), 1)
+
+    def test_late_event_of_finalized_generation(self):
+        merge(self.args, [100, 120])
+        merge(self.args, [900])
+        finalized = dict(STORE['test']['a:0'])
+        live      = dict(STORE['test']['a'])
+        ## A late event and a replayed event of generation 0 leave both generations unchanged
+        #
+        run(self.args, [{'_time': '110', 'tid': 'a', 'n': 'late'}, {'_time': '100', 'tid': 'a', 'n': '0'}])
+        self.assertEqual(STORE['test']['a:0'], finalized)
+        self.assertEqual(STORE['test']['a'], live)
+        self.assertEqual((live['start_time'], live['end_time'], live['event_count']), (900.0, 900.0, 1))
+
+
+class TestLinking(StoreTestCase):
+    def test_merge_fields_not_in_events(self):
+        ## The linking event carries neither the mvlist field nor the aggregated one
+        #
+        args = ['link_fields=oid', 'mvlist=true', 'agg=b:sum,b:tdigest']
+        run(args, [{'_time': '100', 'tid': 'a', 'u': 'x', 'b': '1'}])
+        run(args, [{'_time': '110', 'oid': 'o1', 'u': 'y', 'b': '2'}])
+        transactions = run(args, [{'_time': '120', 'tid': 'a', 'oid': 'o1'}])
+        self.assertEqual(len(STORE['test']), 1)
+        transaction = STORE['test'].values()[0]
+        self.assertEqual(transactions.values()[0]['_key'], transaction['_key'])
+        self.assertEqual(sorted(transaction['u']), ['x', 'y'])
+        self.assertEqual(transaction['sum_b'], 3)
+        self.assertEqual(transaction['event_count'], 3)
+        self.assertTrue(transaction['__tdigest_b'].endswith('1.0,1;2.0,1'))
+
+
+class TestHighWaterMark(unittest.TestCase):
+    def test_default_lag(self):
+        ## Events indexed up to an hour late are kept by default, older ones dropped
+        #
+        command = kvtransaction()
+        CommandLineParser.parse(command, ['hwm=true', 'transaction_id=tid', 'collection=test'])
+        mark = HighWaterMark({'time': '10000'}, command.hwm_lag)
+        self.assertFalse(mark.drops(9000 * 1000000, 'digest'))
+        self.assertTrue(mark.drops(6000 * 1000000, 'digest'))
+
+
+class TestProvision(StoreTestCase):
+    def test_convert_legacy_transactions(self):
+        STORE['test'] = dict([('t%d' % index, {'_key': 't%d' % index, '_time': '%d.5' % (1000 + index), 'duration': '2.25'}) for index in range(5)])
+        STORE['test']['new'] = {'_key': 'new', '_time': 900, 'start_time': 900, 'end_time': 910, 'duration': 10}
+        saver = BatchSaver('app', 'test', 'session', 100, 1000000, 1)
+        self.assertEqual(convert_legacy_transactions('app', 'test', 'session', saver, page_size=2), 5)
+        saver.close()
+        self.assertEqual(STORE['test']['t3'], {'_key': 't3', '_time': 1003.5, 'start_time': 1003.5, 'end_time': 1005.75, 'duration': 2.25})
+        self.assertEqual(STORE['test']['new']['end_time'], 910)
+
+
+class TestAggregates(StoreTestCase):
+    def test_tdigest_non_numeric(self):
+        ## A digest stored before any numeric value arrived has to load in the next run
+        #
+        run(['agg=latency:tdigest'], [{'_time': '100', 'tid': 'a', 'latency': '-'}])
+        self.assertEqual(STORE['test']['a']['__tdigest_latency'], 'tdigest:200:::')
+        run(['agg=latency:tdigest'], [{'_time': '110', 'tid': 'a', 'latency': '5'}])
+        self.assertEqual(STORE['test']['a']['__tdigest_latency'], 'tdigest:200:5.0:5.0:5.0,1')
+
+
+if __name__ == '__main__':
+    unittest.main()